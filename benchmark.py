@@ -0,0 +1,4 @@
+from src import ModelOptions, benchmark
+
+options = ModelOptions().parse()
+benchmark(options)
@@ -0,0 +1,4 @@
+from src import ModelOptions, load_test
+
+options = ModelOptions().parse()
+load_test(options)
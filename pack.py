@@ -0,0 +1,4 @@
+from src import ModelOptions, pack
+
+options = ModelOptions().parse()
+pack(options)
@@ -0,0 +1,4 @@
+from src import ModelOptions, scan
+
+options = ModelOptions().parse()
+scan(options)
@@ -2,4 +2,6 @@ from .options import *
 from .models import *
 from .utils import *
 from .dataset import *
-from .main import *
\ No newline at end of file
+from .main import *
+from .benchmark import *
+from .server import *
\ No newline at end of file
@@ -0,0 +1,256 @@
+from __future__ import print_function
+
+import os
+import copy
+import json
+import time
+import platform
+import collections
+import numpy as np
+import tensorflow as tf
+
+from .models import create_model, median_time
+from .ops import rgb_to_lab, lab_to_rgb
+from .dataset import CIFAR10_DATASET
+from .main import session_config
+
+
+def benchmark_sampler(options, batch_size, size, bn_training=True, runs=10):
+    '''
+    measures the generator latency on random grayscale inputs
+    returns the median seconds per batch
+    '''
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        model = create_model(sess, options)
+        gen_factory = model.create_generator()
+
+        input_gray = tf.placeholder(tf.float32, shape=(None, None, None, 1), name='input_gray')
+        sampler = gen_factory.create(input_gray, 4, options.seed, bn_training=bn_training)
+        sess.run(tf.global_variables_initializer())
+
+        feed_dic = {input_gray: np.random.uniform(0, 255, (batch_size, size, size, 1))}
+        return median_time(lambda: sess.run(sampler, feed_dict=feed_dic), runs)
+
+
+def benchmark_train_step(options, batch_size, size, inputs=None, runs=10):
+    '''
+    measures the training step throughput on a batch of RGB inputs, random if inputs is None
+    returns the median images per second
+    '''
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph, config=session_config(options)) as sess:
+        model = create_model(sess, options)
+        model.build()
+        sess.run(tf.global_variables_initializer())
+
+        if inputs is None:
+            inputs = np.random.uniform(0, 255, (batch_size, size, size, 3))
+
+        feed_dic = model.feed_rgb(inputs)
+        return len(inputs) / median_time(lambda: model.train_step(feed_dic), runs)
+
+
+def benchmark_data(options, batch_size, batches=20):
+    '''
+    measures the training set generator throughput, decoding and augmentation included
+    returns the images per second
+    '''
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        model = create_model(sess, options)
+
+        # the file list is loaded and shuffled once, outside of the measurement
+        len(model.dataset_train)
+
+        generator = model.dataset_train.generator(batch_size, workers=options.workers, prefetch=options.prefetch, transform=model.input_transform())
+        total = 0
+        start = time.time()
+
+        for batch in generator:
+            total += len(batch)
+            batches -= 1
+            if batches == 0:
+                break
+
+        elapsed = time.time() - start
+        generator.close()
+
+    return total / elapsed
+
+
+def load_batch(options, batch_size):
+    '''
+    returns a batch of real training images, or None if the dataset is not available
+    '''
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        model = create_model(sess, options)
+
+        try:
+            return next(model.dataset_train.generator(batch_size))
+
+        except (IOError, OSError, StopIteration):
+            return None
+
+
+def benchmark_color(batch_size, size, lut=False, runs=10):
+    '''
+    measures the RGB => LAB => RGB conversion latency on random 8-bit inputs
+    returns (median seconds per RGB => LAB batch, median seconds per LAB => RGB batch, LAB outputs, RGB outputs)
+    '''
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        rgb = tf.placeholder(tf.float32, shape=(None, None, None, 3))
+        lab = tf.placeholder(tf.float32, shape=(None, None, None, 3))
+        to_lab = rgb_to_lab(rgb, lut=lut)
+        to_rgb = lab_to_rgb(lab, lut=lut)
+
+        rng = np.random.RandomState(0)
+        inputs = rng.randint(0, 256, (batch_size, size, size, 3)) / 255.0
+        outputs_lab = sess.run(to_lab, feed_dict={rgb: inputs})
+        outputs_rgb = sess.run(to_rgb, feed_dict={lab: outputs_lab})
+
+        time_lab = median_time(lambda: sess.run(to_lab, feed_dict={rgb: inputs}), runs)
+        time_rgb = median_time(lambda: sess.run(to_rgb, feed_dict={lab: outputs_lab}), runs)
+
+    return time_lab, time_rgb, outputs_lab, outputs_rgb
+
+
+def environment(options):
+    '''
+    returns the host, library versions and model options the benchmark results depend on
+    '''
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'tensorflow': tf.__version__,
+        'numpy': np.__version__,
+        'dataset': options.dataset,
+        'batch_size': options.batch_size,
+        'data_format': options.data_format,
+        'fused_bn': options.fused_bn,
+        'inference_bn': options.inference_bn,
+        'color_lut': options.color_lut,
+        'host_preprocess': options.host_preprocess,
+        'workers': options.workers,
+        'cpu_towers': options.cpu_towers,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    compares results to baseline results: latencies (_ms) are lower-is-better, throughputs (_per_sec) higher-is-better
+    returns the list of regressions larger than tolerance, as messages
+    '''
+    regressions = []
+
+    for name, value in results.items():
+        if name not in baseline or value <= 0 or baseline[name] <= 0:
+            continue
+
+        if name.endswith('_per_sec'):
+            slowdown = baseline[name] / value - 1
+        else:
+            slowdown = value / baseline[name] - 1
+
+        if slowdown > tolerance:
+            regressions.append('%s: %.2f - baseline: %.2f - %.1f%% slower' % (name, value, baseline[name], slowdown * 100))
+
+    return regressions
+
+
+def benchmark(options):
+    size = 32 if options.dataset == CIFAR10_DATASET else 256
+    sizes = [int(x) for x in options.benchmark_sizes.split(',')] if options.benchmark_sizes else [size // 2, size]
+    batch_sizes = [int(x) for x in options.benchmark_batch_sizes.split(',')]
+    runs = options.benchmark_runs
+    results = collections.OrderedDict()
+
+    def record(name, value):
+        results[name] = float(value)
+        print('%-48s %10.2f' % (name, value))
+
+    configs = [
+        ('batch_stats', True, False),
+        ('batch_stats_fused', True, True),
+        ('moving_stats_fused', False, True),
+    ]
+
+    print('\ncolor conversion, batch size: %d, 256x256 inputs:' % options.batch_size)
+    to_lab, to_rgb, lab, rgb = benchmark_color(options.batch_size, 256, runs=runs)
+    to_lab_lut, to_rgb_lut, lab_lut, rgb_lut = benchmark_color(options.batch_size, 256, lut=True, runs=runs)
+    record('color_rgb_to_lab_ms', to_lab * 1e3)
+    record('color_rgb_to_lab_lut_ms', to_lab_lut * 1e3)
+    record('color_lab_to_rgb_ms', to_rgb * 1e3)
+    record('color_lab_to_rgb_lut_ms', to_rgb_lut * 1e3)
+    print('lut max abs difference: rgb => lab: %e - lab => rgb: %e' % (np.max(np.abs(lab - lab_lut)), np.max(np.abs(rgb - rgb_lut))))
+
+    print('\n%s generator latency, %s:' % (options.dataset, options.data_format))
+    for batch_size in batch_sizes:
+        for input_size in sizes:
+            latency = benchmark_sampler(options, batch_size, input_size, bn_training=not options.inference_bn, runs=runs)
+            record('sampler_b%d_%dpx_ms' % (batch_size, input_size), latency * 1e3)
+
+    for name, bn_training, fused_bn in configs:
+        config = copy.copy(options)
+        config.fused_bn = fused_bn
+        latency = benchmark_sampler(config, 1, size, bn_training=bn_training, runs=runs)
+        record('sampler_b1_%dpx_%s_ms' % (size, name), latency * 1e3)
+
+    print('\n%s training step, batch size: %d:' % (options.dataset, options.batch_size))
+    config = copy.copy(options)
+    config.mode = 0
+    record('train_synthetic_images_per_sec', benchmark_train_step(config, options.batch_size, size, runs=runs))
+
+    inputs = load_batch(options, options.batch_size)
+    if inputs is None:
+        print('%s dataset not found in %s, skipping the real-data benchmarks' % (options.dataset, options.dataset_path))
+
+    else:
+        record('train_real_images_per_sec', benchmark_train_step(config, options.batch_size, size, inputs=inputs, runs=runs))
+
+        print('\n%s data loading, batch size: %d, workers: %d:' % (options.dataset, options.batch_size, options.workers))
+        record('data_images_per_sec', benchmark_data(options, options.batch_size, batches=2 * runs))
+
+    # data-parallel scaling over logical CPU devices
+    if options.cpu_towers > 1:
+        print('\n%s training step scaling, batch size: %d' % (options.dataset, options.batch_size))
+
+        config.cpu_towers = 1
+        single = benchmark_train_step(config, options.batch_size, size, runs=runs)
+
+        config.cpu_towers = options.cpu_towers
+        multi = benchmark_train_step(config, options.batch_size, size, runs=runs)
+
+        record('train_towers_1_images_per_sec', single)
+        record('train_towers_%d_images_per_sec' % options.cpu_towers, multi)
+        print('scaling efficiency: %.1f%%' % (100 * multi / (single * options.cpu_towers)))
+
+    report = {'environment': environment(options), 'results': results}
+
+    if options.benchmark_output:
+        with open(options.benchmark_output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        print('\nresults saved to %s' % options.benchmark_output)
+
+    if options.benchmark_baseline:
+        with open(options.benchmark_baseline) as f:
+            baseline = json.load(f)
+
+        for key in ['platform', 'cpu_count', 'tensorflow']:
+            if baseline['environment'].get(key) != report['environment'][key]:
+                print('warning: the baseline %s differs: %s' % (key, baseline['environment'].get(key)))
+
+        regressions = compare(results, baseline['results'], options.benchmark_tolerance)
+        if len(regressions) > 0:
+            raise RuntimeError('performance regressions against %s:\n%s' % (options.benchmark_baseline, '\n'.join(regressions)))
+
+        print('no regressions against %s' % options.benchmark_baseline)
+
+    return report
@@ -0,0 +1,97 @@
+from __future__ import print_function
+
+import os
+import time
+import queue
+import threading
+import tensorflow as tf
+
+
+class AsyncCheckpointSaver:
+    '''
+    Saves checkpoints on a background thread: the variables are copied to host memory on the
+    training thread, then written by a saver in a separate graph holding variables of the same
+    names, so the checkpoints are restored by the model saver.
+    '''
+    def __init__(self, sess, var_list, max_to_keep=5, keep_checkpoint_every_n_hours=10000.0):
+        self.sess = sess
+        self.var_list = var_list
+        self.max_to_keep = max_to_keep
+        self.keep_checkpoint_every_n_hours = keep_checkpoint_every_n_hours
+        self.error = None
+        self.last_path = None
+        self.last_write_time = 0
+
+        # at most one snapshot is queued or being written at a time
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = None
+
+    def save(self, save_path, global_step):
+        '''
+        snapshots the variables and queues them for writing, waits for the previous write first
+        returns the seconds training was stalled
+        '''
+        start = time.time()
+        self.wait()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+        values = self.sess.run(self.var_list)
+        self._queue.put((values, save_path, global_step))
+
+        return time.time() - start
+
+    def wait(self):
+        '''
+        blocks until the queued checkpoint is written, re-raises a failed write
+        '''
+        self._queue.join()
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        graph = tf.Graph()
+        with graph.as_default():
+            placeholders = [tf.placeholder(var.dtype.base_dtype, shape=var.get_shape()) for var in self.var_list]
+            variables = [
+                tf.Variable(placeholder, name=var.op.name, trainable=False)
+                for var, placeholder in zip(self.var_list, placeholders)
+            ]
+
+            init = tf.variables_initializer(variables)
+            saver = tf.train.Saver(variables, max_to_keep=self.max_to_keep, keep_checkpoint_every_n_hours=self.keep_checkpoint_every_n_hours)
+
+        with tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            recovered = False
+
+            while True:
+                values, save_path, global_step = self._queue.get()
+
+                try:
+                    start = time.time()
+
+                    # the retention policy also applies to the checkpoints of previous runs
+                    if not recovered:
+                        ckpt = tf.train.get_checkpoint_state(os.path.dirname(save_path))
+                        if ckpt is not None:
+                            saver.recover_last_checkpoints(ckpt.all_model_checkpoint_paths)
+
+                        recovered = True
+
+                    sess.run(init, feed_dict=dict(zip(placeholders, values)))
+
+                    # the checkpoint state file is only updated once the checkpoint files are complete
+                    self.last_path = saver.save(sess, save_path, global_step=global_step, write_meta_graph=False)
+                    self.last_write_time = time.time() - start
+
+                except Exception as error:
+                    self.error = error
+
+                finally:
+                    del values
+                    self._queue.task_done()
@@ -0,0 +1,110 @@
+import numpy as np
+from .ops import COLORSPACE_RGB, COLORSPACE_LAB
+
+# vectorized NumPy counterparts of the color space ops, for data loading workers
+
+RGB_TO_XYZ = np.array([
+    #    X        Y          Z
+    [0.412453, 0.212671, 0.019334],  # R
+    [0.357580, 0.715160, 0.119193],  # G
+    [0.180423, 0.072169, 0.950227],  # B
+], dtype=np.float32)
+
+XYZ_TO_RGB = np.array([
+    #     r           g          b
+    [3.2404542, -0.9692660, 0.0556434],  # x
+    [-1.5371385, 1.8760108, -0.2040259],  # y
+    [-0.4985314, 0.0415560, 1.0572252],  # z
+], dtype=np.float32)
+
+FXFYFZ_TO_LAB = np.array([
+    #  l       a       b
+    [0.0, 500.0, 0.0],  # fx
+    [116.0, -500.0, 200.0],  # fy
+    [0.0, 0.0, -200.0],  # fz
+], dtype=np.float32)
+
+LAB_TO_FXFYFZ = np.array([
+    #   fx      fy        fz
+    [1 / 116.0, 1 / 116.0, 1 / 116.0],  # l
+    [1 / 500.0, 0.0, 0.0],  # a
+    [0.0, 0.0, -1 / 200.0],  # b
+], dtype=np.float32)
+
+D65_WHITE = np.array([0.950456, 1.0, 1.088754], dtype=np.float32)
+
+# same weights as tf.image.rgb_to_grayscale
+GRAYSCALE_WEIGHTS = np.array([0.2989, 0.5870, 0.1140], dtype=np.float32)
+
+
+def rgb_to_grayscale(img):
+    return np.dot(np.asarray(img, dtype=np.float32), GRAYSCALE_WEIGHTS)[..., None]
+
+
+def rgb_to_lab(srgb):
+    srgb = np.asarray(srgb, dtype=np.float32)
+    epsilon = 6 / 29
+
+    rgb = np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+    xyz = np.dot(rgb, RGB_TO_XYZ) / D65_WHITE
+
+    fxfyfz = np.where(xyz <= epsilon**3, xyz / (3 * epsilon**2) + 4 / 29, np.cbrt(xyz))
+    lab = np.dot(fxfyfz, FXFYFZ_TO_LAB) + np.array([-16.0, 0.0, 0.0], dtype=np.float32)
+
+    return lab.astype(np.float32)
+
+
+def lab_to_rgb(lab):
+    lab = np.asarray(lab, dtype=np.float32)
+    epsilon = 6 / 29
+
+    fxfyfz = np.dot(lab + np.array([16.0, 0.0, 0.0], dtype=np.float32), LAB_TO_FXFYFZ)
+    xyz = np.where(fxfyfz <= epsilon, 3 * epsilon**2 * (fxfyfz - 4 / 29), fxfyfz ** 3) * D65_WHITE
+
+    # avoid a slightly negative number messing up the conversion
+    rgb = np.clip(np.dot(xyz, XYZ_TO_RGB), 0.0, 1.0)
+    srgb = np.where(rgb <= 0.0031308, rgb * 12.92, (rgb ** (1 / 2.4) * 1.055) - 0.055)
+
+    return srgb.astype(np.float32)
+
+
+def preprocess(img, colorspace_in, colorspace_out):
+    img = np.asarray(img, dtype=np.float32)
+
+    if colorspace_out.upper() == COLORSPACE_RGB:
+        if colorspace_in == COLORSPACE_LAB:
+            img = lab_to_rgb(img)
+
+        # [0, 1] => [-1, 1]
+        img = (img / 255.0) * 2 - 1
+
+    elif colorspace_out.upper() == COLORSPACE_LAB:
+        if colorspace_in == COLORSPACE_RGB:
+            img = rgb_to_lab(img / 255.0)
+
+        # L: [0, 100] => [-1, 1]
+        # A, B: [-110, 110] => [-1, 1]
+        img = np.stack([img[..., 0] / 50 - 1, img[..., 1] / 110, img[..., 2] / 110], axis=-1)
+
+    return img.astype(np.float32)
+
+
+def postprocess(img, colorspace_in, colorspace_out):
+    img = np.asarray(img, dtype=np.float32)
+
+    if colorspace_in.upper() == COLORSPACE_RGB:
+        # [-1, 1] => [0, 1]
+        img = (img + 1) / 2
+
+        if colorspace_out == COLORSPACE_LAB:
+            img = rgb_to_lab(img)
+
+    elif colorspace_in.upper() == COLORSPACE_LAB:
+        # L: [-1, 1] => [0, 100]
+        # A, B: [-1, 1] => [-110, 110]
+        img = np.stack([(img[..., 0] + 1) / 2 * 100, img[..., 1] * 110, img[..., 2] * 110], axis=-1)
+
+        if colorspace_out == COLORSPACE_RGB:
+            img = lab_to_rgb(img)
+
+    return img.astype(np.float32)
@@ -1,13 +1,28 @@
 import os
 import glob
+import json
+import hashlib
+import collections
 import numpy as np
 import tensorflow as tf
 from scipy.misc import imread
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from .utils import unpickle
 
 CIFAR10_DATASET = 'cifar10'
 PLACES365_DATASET = 'places365'
+PACKED_INDEX_FILE = 'index.json'
+FILE_INDEX_SUFFIX = '.index'
+VALIDITY_INDEX_FILE = 'validity.idx'
+
+IMAGE_VALID = 0
+IMAGE_GRAYSCALE = 1
+IMAGE_NEAR_GRAYSCALE = 2
+IMAGE_CORRUPT = 3
+
+# mean absolute difference between the color channels below which an image is nearly grayscale
+NEAR_GRAYSCALE_TOLERANCE = 2.0
 
 
 class BaseDataset():
@@ -16,6 +31,13 @@ class BaseDataset():
         self.augment = augment and training
         self.training = training
         self.path = path
+        self.num_shards = 1
+        self.shard_index = 0
+        self.validity_file = None
+        self.skip_near_grayscale = False
+        self.seed = None
+        self.position = 0
+        self.index_rejected = 0
         self._data = []
 
     def __len__(self):
@@ -30,53 +52,149 @@ class BaseDataset():
             start += 1
             yield item
 
-        raise StopIteration
-
     def __getitem__(self, index):
         val = self.data[index]
         try:
-            img = imread(val) if isinstance(val, str) else val
+            img = self.read(val)
 
-            # grayscale images
-            if np.sum(img[:,:,0] - img[:,:,1]) == 0 and np.sum(img[:,:,0] - img[:,:,2]) == 0:
-                return None
+        except Exception:
+            return None
 
-            if self.augment and np.random.binomial(1, 0.5) == 1:
-                img = img[:, ::-1, :]
+        if not self.is_valid(classify_image(img)):
+            return None
 
-        except:
-            img = None
+        if self.augment and np.random.binomial(1, 0.5) == 1:
+            img = img[:, ::-1, :]
 
         return img
 
-    def generator(self, batch_size, recusrive=False):
-        start = 0
+    def indexed_valid(self, entry, path):
+        """
+        Returns whether to keep a file given its validity index entry (modification time in ns, image status).
+        Only the rejected files are checked for modifications, files indexed as valid are classified when read.
+        """
+        if entry is None or self.is_valid(entry[1]):
+            return True
+
+        try:
+            return os.stat(path).st_mtime_ns != entry[0]
+        except OSError:
+            return False
+
+    def is_valid(self, status):
+        return status == IMAGE_VALID or (status == IMAGE_NEAR_GRAYSCALE and not self.skip_near_grayscale)
+
+    def generator(self, batch_size, recusrive=False, workers=0, prefetch=2, transform=None, start=0):
+        """
+        Yields batches of exactly batch_size valid images, the last batch of a non-recursive pass may be smaller.
+        With workers > 0, images are decoded and augmented on a thread pool, prefetch batches ahead.
+        The optional transform is applied to each valid image on the same workers.
+        The first pass starts at index start, the images before it are not read. When a batch is yielded,
+        self.position is the index following its last image.
+        """
+        def load(ix):
+            item = self[ix]
+            if item is None or transform is None:
+                return ix, item
+
+            return ix, transform(item)
+
+        if workers > 0:
+            items = self._prefetch_items(load, self._indices(recusrive, start), workers, prefetch * batch_size)
+        else:
+            items = (load(ix) for ix in self._indices(recusrive, start))
+
+        batch = []
+        for ix, item in items:
+            if item is None:
+                continue
+
+            batch.append(item)
+            if len(batch) == batch_size:
+                self.position = ix + 1
+                yield batch
+                batch = []
+
+        if len(batch) > 0:
+            self.position = len(self)
+            yield batch
+
+    def _indices(self, recusrive=False, start=0):
         total = len(self)
 
         while True:
-            while start < total:
-                end = np.min([start + batch_size, total])
-                items = []
+            for ix in range(start, total):
+                yield ix
 
-                for ix in range(start, end):
-                    item = self[ix]
-                    if item is not None:
-                        items.append(item)
+            start = 0
+            if not recusrive or total == 0:
+                return
 
-                start = end
-                yield items
+    def _prefetch_items(self, load, indices, workers, size):
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = collections.deque()
 
-            if recusrive:
-                start = 0
-
-            else:
-                raise StopIteration
+        try:
+            for ix in indices:
+                pending.append(executor.submit(load, ix))
+                if len(pending) >= size:
+                    yield pending.popleft().result()
+
+            while len(pending) > 0:
+                yield pending.popleft().result()
+
+        finally:
+            for future in pending:
+                future.cancel()
+
+            executor.shutdown(wait=False)
+
+    def read(self, val):
+        return imread(val) if isinstance(val, str) else val
+
+    def key(self, val):
+        """
+        returns the path of an item, as recorded in the validity index
+        """
+        return val
+
+    def set_seed(self, seed):
+        """
+        Sets the seed of the data order, the data is reloaded and shuffled on next access if it changes.
+        """
+        if seed != self.seed:
+            self.seed = seed
+            self._data = []
+
+    def shard(self, num_shards, index):
+        """
+        Restricts the dataset to every num_shards-th item, starting at index.
+        Shards are disjoint only when all shards are shuffled with the same random seed.
+        """
+        self.num_shards = num_shards
+        self.shard_index = index
+        self._data = []
 
     @property
     def data(self):
         if len(self._data) == 0:
             self._data = self.load()
-            np.random.shuffle(self._data)
+            self.index_rejected = 0
+
+            # files rejected by scan_dataset are never opened again, unless modified since the scan
+            if self.validity_file and os.path.exists(self.validity_file):
+                index = load_validity_index(self.validity_file)
+                valid = np.array([self.indexed_valid(index.get(key), key) for key in map(self.key, self._data)], dtype=bool)
+                self._data = np.asarray(self._data)[valid]
+                self.index_rejected = int(np.count_nonzero(~valid))
+
+            # with a seed, the order does not depend on the global random state and can be reproduced
+            if self.seed is None:
+                np.random.shuffle(self._data)
+            else:
+                np.random.RandomState(self.seed).shuffle(self._data)
+
+            self._data = self._data[self.shard_index::self.num_shards]
 
         return self._data
 
@@ -88,54 +206,386 @@ class BaseDataset():
 class Cifar10Dataset(BaseDataset):
     def __init__(self, path, training=True, augment=True):
         super(Cifar10Dataset, self).__init__(CIFAR10_DATASET, path, training, augment)
+        self._images = []
+
+    def read(self, val):
+        return self._images[val]
 
     def load(self):
-        data = []
         if self.training:
-            for i in range(1, 6):
-                filename = '{}/data_batch_{}'.format(self.path, i)
-                batch_data = unpickle(filename)
-                if len(data) > 0:
-                    data = np.vstack((data, batch_data[b'data']))
-                else:
-                    data = batch_data[b'data']
+            filenames = ['{}/data_batch_{}'.format(self.path, i) for i in range(1, 6)]
+        else:
+            filenames = ['{}/test_batch'.format(self.path)]
+
+        # the cache is keyed by the size and modification time of the source files
+        signature = hashlib.md5()
+        for filename in filenames:
+            stat = os.stat(filename)
+            signature.update(('%s %d %d\n' % (os.path.basename(filename), stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+
+        prefix = 'cache_' + ('train' if self.training else 'test') + '_'
+        cache = os.path.join(self.path, prefix + signature.hexdigest()[:16] + '.npy')
+
+        if os.path.exists(cache):
+            self._images = np.load(cache, mmap_mode='r')
 
         else:
-            filename = '{}/test_batch'.format(self.path)
-            batch_data = unpickle(filename)
-            data = batch_data[b'data']
-
-        w = 32
-        h = 32
-        s = w * h
-        data = np.array(data)
-        data = np.dstack((data[:, :s], data[:, s:2 * s], data[:, 2 * s:]))
-        data = data.reshape((-1, w, h, 3))
-        return data
+            data = np.concatenate([unpickle(filename)[b'data'] for filename in filenames])
+
+            # [N, 3 * 32 * 32] planar => [N, 32, 32, 3]
+            self._images = np.ascontiguousarray(data.reshape((-1, 3, 32, 32)).transpose((0, 2, 3, 1)), dtype=np.uint8)
+
+            try:
+                # write atomically, concurrent runs may be creating the same cache
+                tmp = '%s.%d.tmp' % (cache, os.getpid())
+                with open(tmp, 'wb') as f:
+                    np.save(f, self._images)
+
+                os.rename(tmp, cache)
+
+                for stale in glob.glob(os.path.join(self.path, prefix + '*.npy')):
+                    if stale != cache:
+                        os.remove(stale)
+
+                self._images = np.load(cache, mmap_mode='r')
+
+            except OSError:
+                pass
+
+        return np.arange(len(self._images))
 
 
 class Places365Dataset(BaseDataset):
-    def __init__(self, path, training=True, augment=True):
+    def __init__(self, path, training=True, augment=True, skip_near_grayscale=False, workers=0):
         super(Places365Dataset, self).__init__(PLACES365_DATASET, path, training, augment)
+        self.validity_file = os.path.join(path, VALIDITY_INDEX_FILE)
+        self.skip_near_grayscale = skip_near_grayscale
+        self.workers = workers
+        self._files = None
+
+    def read(self, val):
+        return imread(self.key(val))
+
+    def key(self, val):
+        return self._files[val]
 
     def load(self):
-        if self.training:
-            flist = os.path.join(self.path, 'train.flist')
+        split = 'train' if self.training else 'test'
+        index = os.path.join(self.path, split + FILE_INDEX_SUFFIX)
+
+        if not os.path.exists(index):
+            # a file list from previous versions is converted, otherwise the image directory is walked
+            flist = os.path.join(self.path, split + '.flist')
             if os.path.exists(flist):
-                data = np.genfromtxt(flist, dtype=np.str, encoding='utf-8')
+                with open(flist, encoding='utf-8') as f:
+                    paths = [line.rstrip('\n') for line in f if line.strip()]
+
+            elif self.training:
+                paths = walk_files(self.path + '/data_256', '.jpg', self.workers)
+
             else:
-                data = glob.glob(self.path + '/data_256/**/*.jpg', recursive=True)
-                np.savetxt(flist, data, fmt='%s')
+                paths = walk_files(self.path + '/val_256', '.jpg', self.workers, recursive=False)
+
+            write_file_index(index, paths)
+
+        self._files = FileIndex(index)
+        return np.arange(len(self._files))
+
+
+class PackedDataset(BaseDataset):
+    """
+    Serves images from fixed-shape uint8 shards written by pack_dataset, memory-mapped read-only.
+    """
+    def __init__(self, name, path, training=True, augment=True):
+        super(PackedDataset, self).__init__(name, path, training, augment)
+        self._shards = []
+        self._offsets = []
 
+    def __getitem__(self, index):
+        ix = self.data[index]
+        shard = np.searchsorted(self._offsets, ix, side='right') - 1
+        img = self._shards[shard][ix - self._offsets[shard]]
+
+        # grayscale and unreadable images are dropped when packing
+        if self.augment and np.random.binomial(1, 0.5) == 1:
+            img = img[:, ::-1, :]
+
+        return img
+
+    def load(self):
+        with open(os.path.join(self.path, PACKED_INDEX_FILE)) as f:
+            index = json.load(f)
+
+        shape = tuple(index['shape'])
+        counts = [count for _, count in index['shards']]
+
+        self._shards = [
+            np.memmap(os.path.join(self.path, filename), dtype=np.uint8, mode='r', shape=(count,) + shape)
+            for filename, count in index['shards']
+        ]
+        self._offsets = np.cumsum([0] + counts)[:-1]
+
+        return np.arange(np.sum(counts, dtype=np.int64))
+
+
+def pack_dataset(dataset, path, shard_size=4096, workers=0):
+    """
+    Writes the valid images of a dataset into contiguous uint8 shards plus an index readable by PackedDataset.
+    Images whose shape differs from the first valid image are dropped.
+    returns (number of packed images, number of dropped images)
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    shape = None
+    shards = []
+    packed = 0
+    read = 0
+    mismatched = 0
+    f = None
+
+    try:
+        for batch in dataset.generator(256, workers=workers):
+            for img in batch:
+                read += 1
+                img = np.asarray(img, dtype=np.uint8)
+                shape = shape or img.shape
+
+                if img.shape != shape:
+                    mismatched += 1
+                    continue
+
+                if f is None or shards[-1][1] == shard_size:
+                    if f is not None:
+                        f.close()
+
+                    shards.append(['shard_%05d.bin' % len(shards), 0])
+                    f = open(os.path.join(path, shards[-1][0]), 'wb')
+
+                f.write(np.ascontiguousarray(img).tobytes())
+                shards[-1][1] += 1
+                packed += 1
+
+    finally:
+        if f is not None:
+            f.close()
+
+    # the index is written last, so a partially packed directory is never readable
+    tmp = os.path.join(path, PACKED_INDEX_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'shape': list(shape or ()), 'shards': shards}, f)
+
+    os.rename(tmp, os.path.join(path, PACKED_INDEX_FILE))
+
+    # the files rejected by the validity index are not in the dataset, the generator skips the invalid images
+    dropped = dataset.index_rejected + (len(dataset) - read) + mismatched
+    return packed, dropped
+
+
+class FileIndex():
+    """
+    A list of file paths stored as their common prefix, a concatenated utf-8 blob of the remaining parts
+    and the offsets of each path in the blob, written by write_file_index. The blob and the offsets are
+    memory-mapped read-only, the paths are decoded on access.
+    """
+    def __init__(self, path):
+        with open(path, encoding='utf-8') as f:
+            header = json.load(f)
+
+        self.prefix = header['prefix']
+        self._count = header['count']
+        self._offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+
+        # empty files cannot be memory-mapped
+        if self._offsets[-1] > 0:
+            self._blob = np.memmap(path + '.paths', dtype=np.uint8, mode='r')
         else:
-            flist = os.path.join(self.path, 'test.flist')
-            if os.path.exists(flist):
-                data = np.genfromtxt(flist, dtype=np.str, encoding='utf-8')
-            else:
-                data = np.array(glob.glob(self.path + '/val_256/*.jpg'))
-                np.savetxt(flist, data, fmt='%s')
+            self._blob = np.zeros(0, dtype=np.uint8)
 
-        return data
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return self.prefix + self._blob[start:end].tobytes().decode('utf-8')
+
+
+def write_file_index(path, paths):
+    """
+    Writes a list of file paths readable by FileIndex: the blob to path.paths, the offsets to path.offsets.npy
+    and the header with the common prefix and the number of paths to path, last.
+    """
+    prefix = os.path.commonprefix(paths) if len(paths) > 1 else ''
+    encoded = [path[len(prefix):].encode('utf-8') for path in paths]
+
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in encoded])
+
+    with open(path + '.paths', 'wb') as f:
+        f.write(b''.join(encoded))
+
+    with open(path + '.offsets.npy', 'wb') as f:
+        np.save(f, offsets)
+
+    # the header is written last, so a partially written index is never readable
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'prefix': prefix, 'count': len(paths)}, f)
+
+    os.rename(tmp, path)
+
+
+def walk_files(root, suffix, workers=0, recursive=True):
+    """
+    Lists the files under root whose name ends with suffix, hidden files and directories excluded.
+    With workers > 0, the subdirectories of root are walked in parallel.
+    returns the sorted paths
+    """
+    def walk(directory):
+        files = []
+        directories = []
+
+        for entry in os.scandir(directory):
+            if entry.name.startswith('.'):
+                continue
+
+            if entry.is_dir():
+                directories.append(entry.path)
+
+            elif entry.name.endswith(suffix):
+                files.append(entry.path)
+
+        return files, directories
+
+    def walk_tree(directory):
+        files, directories = walk(directory)
+        for subdirectory in directories:
+            files.extend(walk_tree(subdirectory))
+
+        return files
+
+    files, directories = walk(root)
+
+    if recursive:
+        if workers > 0:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for subtree in executor.map(walk_tree, directories):
+                    files.extend(subtree)
+        else:
+            for directory in directories:
+                files.extend(walk_tree(directory))
+
+    return sorted(files)
+
+
+def classify_image(img):
+    """
+    returns IMAGE_VALID, IMAGE_GRAYSCALE or IMAGE_NEAR_GRAYSCALE for a decoded image
+    """
+    img = np.asarray(img)
+
+    # single channel images
+    if img.ndim != 3 or img.shape[2] < 3:
+        return IMAGE_GRAYSCALE
+
+    # signed differences, uint8 subtraction wraps around
+    img = img[:, :, :3].astype(np.int16)
+    diff = np.abs(img[:, :, 0] - img[:, :, 1]) + np.abs(img[:, :, 0] - img[:, :, 2])
+
+    if not diff.any():
+        return IMAGE_GRAYSCALE
+
+    if diff.mean() < NEAR_GRAYSCALE_TOLERANCE:
+        return IMAGE_NEAR_GRAYSCALE
+
+    return IMAGE_VALID
+
+
+def load_validity_index(path):
+    """
+    Reads a validity index written by scan_dataset.
+    returns a dictionary of path => (modification time in ns, image status)
+    """
+    index = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t', 2)
+
+            # a scan interrupted while writing leaves a truncated last line
+            if len(fields) != 3 or not fields[0].isdigit() or not fields[1].isdigit():
+                continue
+
+            index[fields[2]] = (int(fields[1]), int(fields[0]))
+
+    return index
+
+
+def scan_dataset(dataset, workers=0, chunk_size=1024):
+    """
+    Decodes every image file of a dataset once and records its status in dataset.validity_file.
+    Files already indexed with an unchanged modification time are skipped, so an interrupted scan resumes
+    where it stopped. Each line of the index is: status, modification time in ns and path, tab-separated.
+    returns (dictionary of status => number of scanned files, number of skipped files)
+    """
+    def check(path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return path, 0, IMAGE_CORRUPT
+
+        try:
+            return path, mtime, classify_image(imread(path))
+        except Exception:
+            return path, mtime, IMAGE_CORRUPT
+
+    index = load_validity_index(dataset.validity_file) if os.path.exists(dataset.validity_file) else {}
+    paths = []
+    skipped = 0
+
+    for val in dataset.load():
+        path = str(dataset.key(val))
+        entry = index.get(path)
+
+        try:
+            if entry is not None and entry[0] == os.stat(path).st_mtime_ns:
+                skipped += 1
+                continue
+        except OSError:
+            pass
+
+        paths.append(path)
+
+    counts = dict.fromkeys([IMAGE_VALID, IMAGE_GRAYSCALE, IMAGE_NEAR_GRAYSCALE, IMAGE_CORRUPT], 0)
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    try:
+        # entries are appended chunk by chunk, later entries override earlier ones when loading
+        with open(dataset.validity_file, 'a', encoding='utf-8') as f:
+            for start in range(0, len(paths), chunk_size):
+                chunk = paths[start:start + chunk_size]
+                results = executor.map(check, chunk) if executor else map(check, chunk)
+
+                for path, mtime, status in results:
+                    f.write('%d\t%d\t%s\n' % (status, mtime, path))
+                    index[path] = (mtime, status)
+                    counts[status] += 1
+
+                f.flush()
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # rewrite without the entries of modified files
+    if len(paths) > 0:
+        tmp = dataset.validity_file + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for path, (mtime, status) in index.items():
+                f.write('%d\t%d\t%s\n' % (status, mtime, path))
+
+        os.rename(tmp, dataset.validity_file)
+
+    return counts, skipped
 
 
 class TestDataset(BaseDataset):
@@ -147,6 +597,28 @@ class TestDataset(BaseDataset):
         img = imread(path)
         return path, img
 
+    def generator(self, batch_size, recusrive=False, workers=0, prefetch=2):
+        """
+        Yields batches of (path, image) pairs, images are grouped by size so that each batch can be stacked.
+        """
+        if workers > 0:
+            items = self._prefetch_items(self.__getitem__, self._indices(recusrive), workers, prefetch * batch_size)
+        else:
+            items = (self[ix] for ix in self._indices(recusrive))
+
+        buckets = {}
+        for item in items:
+            shape = item[1].shape
+            bucket = buckets.setdefault(shape, [])
+            bucket.append(item)
+
+            if len(bucket) == batch_size:
+                del buckets[shape]
+                yield bucket
+
+        for bucket in buckets.values():
+            yield bucket
+
     def load(self):
 
         if os.path.isfile(self.path):
@@ -1,10 +1,22 @@
 import os
+import sys
+import time
 import random
+import subprocess
 import numpy as np
 import tensorflow as tf
 from .options import ModelOptions
-from .models import Cifar10Model, Places365Model
-from .dataset import CIFAR10_DATASET, PLACES365_DATASET
+from .models import create_model
+from .utils import run_turing_test, load_turing_pairs
+from .server import serve
+from .dataset import Places365Dataset, pack_dataset, scan_dataset
+from .dataset import PLACES365_DATASET
+from .dataset import IMAGE_VALID, IMAGE_GRAYSCALE, IMAGE_NEAR_GRAYSCALE, IMAGE_CORRUPT
+
+
+def session_config(options):
+    # logical CPU devices for data-parallel towers on CPU-only hosts
+    return tf.ConfigProto(allow_soft_placement=True, device_count={'CPU': max(1, options.cpu_towers)})
 
 
 def main(options):
@@ -19,32 +31,88 @@ def main(options):
     random.seed(options.seed)
 
 
-    # create a session environment
-    with tf.Session() as sess:
+    # replay pre-rendered Turing test pairs without building the model
+    if options.mode == 2 and options.turing_test_pairs and os.path.exists(options.turing_test_pairs):
+        run_turing_test(load_turing_pairs(options.turing_test_pairs), options.turing_test_delay)
+        return
+
+
+    # distributed training: spawn a local parameter server and workers
+    if options.distributed_workers > 0 and not options.job_name:
+        launch(options)
+        return
+
+
+    server = None
+    device = None
+    is_chief = options.job_name != 'worker' or options.task_index == 0
 
-        if options.dataset == CIFAR10_DATASET:
-            model = Cifar10Model(sess, options)
+    if options.job_name:
+        cluster = tf.train.ClusterSpec({'ps': options.ps_hosts.split(','), 'worker': options.worker_hosts.split(',')})
+        server = tf.train.Server(cluster, job_name=options.job_name, task_index=options.task_index, config=session_config(options))
 
-        elif options.dataset == PLACES365_DATASET:
-            model = Places365Model(sess, options)
+        if options.job_name == 'ps':
+            server.join()
+            return
+
+        # variables are placed on the parameter servers, ops on this worker
+        device = tf.train.replica_device_setter(worker_device='/job:worker/task:%d' % options.task_index, cluster=cluster)
+
+        # only the chief worker checkpoints, logs, samples and validates
+        if not is_chief:
+            options.save = False
+            options.sample = False
+            options.validate = False
+            options.log = False
+            options.visualize = False
+
+
+    # create a session environment
+    with tf.Session(server.target if server else '', config=session_config(options)) as sess, tf.device(device):
+
+        model = create_model(sess, options)
 
         if not os.path.exists(options.checkpoints_path):
             os.makedirs(options.checkpoints_path)
 
-        if options.log:
+        # a training run resumed from a checkpoint appends to the logs of the previous runs
+        resume = options.mode == 0 and tf.train.get_checkpoint_state(options.checkpoints_path) is not None
+
+        if options.log and not resume:
             open(model.train_log_file, 'w').close()
             open(model.test_log_file, 'w').close()
 
+            if options.profile_interval > 0:
+                open(model.profile_log_file, 'w').close()
+
         # build the model and initialize
         model.build()
-        sess.run(tf.global_variables_initializer())
+        init = tf.global_variables_initializer()
+        # local variables, such as the streaming validation metrics, are not initialized by the chief
+        uninitialized = tf.report_uninitialized_variables(tf.global_variables()) if not is_chief else None
 
+        # any op created from now on raises an error instead of growing the graph
+        if options.finalize_graph:
+            sess.graph.finalize()
 
-        # load model only after global variables initialization
-        model.load()
 
+        if server is None:
+            sess.run(init)
 
-        if options.mode == 0:
+            # load model only after global variables initialization
+            model.load()
+
+        # the chief restores or initializes the shared variables, the other workers wait for it
+        elif is_chief:
+            if not model.load():
+                sess.run(init)
+
+        else:
+            while len(sess.run(uninitialized)) > 0:
+                time.sleep(1)
+
+
+        if options.mode == 0 and is_chief:
             args = vars(options)
             print('\n------------ Options -------------')
             with open(os.path.join(options.checkpoints_path, 'options.dat'), 'w') as f:
@@ -53,14 +121,90 @@ def main(options):
                     f.write('%s: %s\n' % (str(k), str(v)))
             print('-------------- End ----------------\n')
             
+        if options.mode == 0:
             model.train()
         
         elif options.mode == 1:
             model.test()
 
+        elif options.mode == 3:
+            model.export()
+
+        elif options.mode == 4:
+            model.quantize()
+
+        elif options.mode == 5:
+            serve(model, options)
+
         else:
             model.turing_test()
 
 
+def launch(options):
+    """
+    Runs one parameter server and options.distributed_workers workers as local processes
+    """
+    hosts = ['localhost:%d' % (options.port + index) for index in range(options.distributed_workers + 1)]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    # workers shuffle with the same seed so that their dataset shards are disjoint
+    args = sys.argv[1:] + [
+        '--mode', str(options.mode),
+        '--seed', str(options.seed),
+        '--distributed-workers', '0',
+        '--ps-hosts', hosts[0],
+        '--worker-hosts', ','.join(hosts[1:]),
+    ]
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    command = [sys.executable, '-c', 'from src import ModelOptions, main; main(ModelOptions().parse())']
+
+    ps = subprocess.Popen(command + args + ['--job-name', 'ps', '--task-index', '0'], env=env)
+    workers = [
+        subprocess.Popen(command + args + ['--job-name', 'worker', '--task-index', str(index)], env=env)
+        for index in range(options.distributed_workers)
+    ]
+
+    try:
+        for worker in workers:
+            if worker.wait() != 0:
+                raise RuntimeError('worker exited with code %d' % worker.returncode)
+
+    finally:
+        for process in workers + [ps]:
+            if process.poll() is None:
+                process.terminate()
+
+
+def pack(options):
+    # the cifar10 images are decoded once into memory, only the places365 model reads packed shards
+    if options.dataset != PLACES365_DATASET:
+        print('only the %s images can be packed' % PLACES365_DATASET)
+        return
+
+    packed_path = options.packed_path or os.path.join(options.dataset_path, 'packed')
+
+    for training, split in [(True, 'train'), (False, 'val')]:
+        dataset = Places365Dataset(options.dataset_path, training=training, augment=False, workers=options.workers)
+        print('packing %s %s images...' % (options.dataset, split))
+        packed, dropped = pack_dataset(dataset, os.path.join(packed_path, split), options.shard_size, options.workers)
+        print('packed: %d - dropped: %d' % (packed, dropped))
+
+
+def scan(options):
+    # the cifar10 images are read from the pickled batches, there are no image files to scan
+    if options.dataset != PLACES365_DATASET:
+        print('only the %s image files can be scanned' % PLACES365_DATASET)
+        return
+
+    for training, split in [(True, 'train'), (False, 'val')]:
+        dataset = Places365Dataset(options.dataset_path, training=training, augment=False, workers=options.workers)
+        print('scanning %s %s images...' % (options.dataset, split))
+        counts, skipped = scan_dataset(dataset, options.workers)
+        print('valid: %d - grayscale: %d - near grayscale: %d - corrupt: %d - skipped: %d' % (
+            counts[IMAGE_VALID], counts[IMAGE_GRAYSCALE], counts[IMAGE_NEAR_GRAYSCALE], counts[IMAGE_CORRUPT], skipped))
+
+
 if __name__ == "__main__":
     main(ModelOptions().parse())
@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+import time
+import collections
+import numpy as np
+import tensorflow as tf
+
+
+TRAIN_LOG_COLUMNS = ['epoch', 'step', 'lossD', 'lossD_fake', 'lossD_real', 'lossG', 'lossG_l1', 'lossG_gan', 'acc']
+TEST_LOG_COLUMNS = TRAIN_LOG_COLUMNS
+
+
+class MetricsLogger:
+    '''
+    Appends rows of metrics to a space-separated log file through a buffered file handle,
+    keeps the most recent rows and their moving averages in memory for plotting and
+    optionally writes them as TensorBoard events, from the event writer thread.
+    '''
+    def __init__(self, path, columns, window_width=100, history=10000, flush_interval=10, summary_writer=None, prefix=''):
+        self.path = path
+        self.columns = columns
+        self.window_width = max(1, window_width)
+        self.flush_interval = flush_interval
+        self.summary_writer = summary_writer
+        self.prefix = prefix
+        self.rows = collections.deque(maxlen=history)
+        self.averages = collections.deque(maxlen=history)
+
+        # the epoch and step columns are integers
+        self._format = ' '.join(['%d' if column in ('epoch', 'step') else '%f' for column in columns]) + '\n'
+        self._window = collections.deque()
+        self._window_sum = np.zeros(len(columns))
+        self._file = None
+        self._last_flush = time.time()
+
+    def append(self, *values):
+        values = np.array(values, dtype=np.float64)
+
+        if self._file is None:
+            self._file = open(self.path, 'a')
+
+        self._file.write(self._format % tuple(values))
+        self.rows.append(values)
+
+        # moving average over the last window_width rows, updated in constant time
+        self._window.append(values)
+        self._window_sum += values
+        if len(self._window) > self.window_width:
+            self._window_sum -= self._window.popleft()
+
+        self.averages.append(self._window_sum / len(self._window))
+
+        if self.summary_writer is not None and 'step' in self.columns:
+            step = int(values[self.columns.index('step')])
+            summary = tf.Summary(value=[
+                tf.Summary.Value(tag=self.prefix + column, simple_value=value)
+                for column, value in zip(self.columns, values) if column not in ('epoch', 'step')
+            ])
+            self.summary_writer.add_summary(summary, step)
+
+        if time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def values(self, column, average=False):
+        rows = self.averages if average else self.rows
+        index = self.columns.index(column)
+        return np.array([row[index] for row in rows])
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+        if self.summary_writer is not None:
+            self.summary_writer.flush()
+
+        self._last_flush = time.time()
+
+    def close(self):
+        self.flush()
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
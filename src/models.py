@@ -2,58 +2,182 @@ from __future__ import print_function
 
 import os
 import time
+import queue
+import threading
+import collections
 import numpy as np
 import tensorflow as tf
 
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from .checkpoint import AsyncCheckpointSaver
+from .metrics import MetricsLogger, TRAIN_LOG_COLUMNS, TEST_LOG_COLUMNS
+from .profiler import StepProfiler, PROFILE_LOG_COLUMNS
 from .networks import Generator, Discriminator
-from .ops import pixelwise_accuracy, preprocess, postprocess
+from .ops import pixelwise_accuracy, preprocess, postprocess, average_gradients, average_towers
 from .ops import COLORSPACE_RGB, COLORSPACE_LAB
-from .dataset import Places365Dataset, Cifar10Dataset, TestDataset
-from .utils import stitch_images, turing_test, imshow, imsave, create_dir, visualize, Progbar
+from . import color
+from .dataset import Places365Dataset, Cifar10Dataset, PackedDataset, TestDataset
+from .dataset import CIFAR10_DATASET, PLACES365_DATASET
+from .utils import stitch_images, run_turing_test, save_turing_pairs, imshow, imsave, create_dir, visualize, Progbar
+
+
+# max absolute difference allowed between the exported and the unfolded generator outputs, in [-1, 1]
+EXPORT_TOLERANCE = 1e-3
+
+
+def interval_reached(step, last_step, interval):
+    # with distributed workers the shared global step can advance by more than one between iterations
+    return interval > 0 and step // interval > last_step // interval
+
+
+def run_interpreter(interpreter, inputs):
+    '''
+    runs a TensorFlow Lite model with a single input and output, resized to the batch if needed
+    '''
+    input_details = interpreter.get_input_details()[0]
+    inputs = np.asarray(inputs, dtype=np.float32)
+
+    if tuple(input_details['shape']) != inputs.shape:
+        interpreter.resize_tensor_input(input_details['index'], inputs.shape)
+        interpreter.allocate_tensors()
+
+    interpreter.set_tensor(input_details['index'], inputs)
+    interpreter.invoke()
+    return interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+
+
+def create_model(sess, options):
+    if options.dataset == CIFAR10_DATASET:
+        return Cifar10Model(sess, options)
+
+    return Places365Model(sess, options)
+
+
+def median_time(fn, runs=10):
+    fn()
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+
+    return np.median(times)
 
 
 class BaseModel:
     def __init__(self, sess, options):
+        # the CPU convolution kernels only support channels_last
+        if options.data_format == 'channels_first' and not any(device.device_type == 'GPU' for device in sess.list_devices()):
+            raise ValueError('--data-format channels_first requires a GPU device')
+
         self.sess = sess
         self.options = options
         self.name = options.name
         self.samples_dir = os.path.join(options.checkpoints_path, 'samples')
         self.test_log_file = os.path.join(options.checkpoints_path, 'log_test.dat')
         self.train_log_file = os.path.join(options.checkpoints_path, 'log_train.dat')
+        self.profile_log_file = os.path.join(options.checkpoints_path, 'log_profile.dat')
+        self.summary_writer = tf.summary.FileWriter(os.path.join(options.checkpoints_path, 'events')) if options.log and options.tensorboard else None
+        self.train_log = MetricsLogger(self.train_log_file, TRAIN_LOG_COLUMNS, options.visualize_window, summary_writer=self.summary_writer, prefix='train/')
+        self.test_log = MetricsLogger(self.test_log_file, TEST_LOG_COLUMNS, options.visualize_window, summary_writer=self.summary_writer, prefix='test/')
+        self.profile_log = MetricsLogger(self.profile_log_file, PROFILE_LOG_COLUMNS, options.visualize_window, summary_writer=self.summary_writer, prefix='profile/')
+        self.profiler = StepProfiler(os.path.join(options.checkpoints_path, 'profile'), options.profile_interval)
         self.global_step = tf.Variable(0, name='global_step', trainable=False)
-        self.dataset_train = self.create_dataset(True)
-        self.dataset_val = self.create_dataset(False)
-        self.sample_generator = self.dataset_val.generator(options.sample_size, True)
         self.iteration = 0
         self.epoch = 0
         self.is_built = False
+        self.saver = None
+        self.checkpoint_saver = None
+        self.interpreter = None
+        self.val_cache = None
+        self.val_cache_full = False
+        self.num_towers = 1
+        self._dataset_train = None
+        self._dataset_val = None
+        self._sample_generator = None
+        self._generator_stride = None
+
+    # the datasets are created on first use, the test mode never reads them
+    @property
+    def dataset_train(self):
+        if self._dataset_train is None:
+            self._dataset_train = self.create_dataset(True)
+
+            # distributed training: each worker reads a disjoint shard of the training set
+            if self.options.job_name == 'worker':
+                self._dataset_train.shard(len(self.options.worker_hosts.split(',')), self.options.task_index)
+
+        return self._dataset_train
+
+    @property
+    def dataset_val(self):
+        if self._dataset_val is None:
+            self._dataset_val = self.create_dataset(False)
+
+        return self._dataset_val
+
+    @property
+    def sample_generator(self):
+        if self._sample_generator is None:
+            self._sample_generator = self.dataset_val.generator(self.options.sample_size, True, workers=self.options.workers, prefetch=self.options.prefetch)
+
+        return self._sample_generator
 
     def train(self):
+        last_step = self.sess.run(self.global_step)
+
+        # resume where the restored checkpoint was saved, in the same data order
+        start_epoch, start_iteration, start_position, seed = [int(value) for value in self.sess.run(self.train_state)]
+        self.dataset_train.set_seed(seed)
         total = len(self.dataset_train)
 
-        for epoch in range(self.options.epochs):
+        if start_epoch > 0 or start_position > 0:
+            print('resuming training at epoch: %d - image: %d/%d\n' % (start_epoch + 1, start_position, total))
+
+        for epoch in range(start_epoch, self.options.epochs):
             lr_rate = self.sess.run(self.learning_rate)
 
             print('Training epoch: %d' % (epoch + 1) + " - learning rate: " + str(lr_rate))
 
+            resume = epoch == start_epoch
             self.epoch = epoch + 1
-            self.iteration = 0
-
-            generator = self.dataset_train.generator(self.options.batch_size)
+            self.iteration = start_iteration if resume else 0
+            self.dataset_train.position = start_position if resume else 0
+
+            generator = self.dataset_train.generator(
+                self.options.batch_size,
+                workers=self.options.workers,
+                prefetch=self.options.prefetch,
+                transform=self.input_transform(),
+                start=self.dataset_train.position)
             progbar = Progbar(total, width=25, stateful_metrics=['epoch', 'iter', 'step'])
+            progbar.update(self.dataset_train.position)
+
+            data_start = time.time()
+
+            for batch in generator:
+                data_wait = time.time() - data_start
 
-            for input_rgb in generator:
-                feed_dic = {self.input_rgb: input_rgb}
+                # every tower needs at least one image
+                if len(batch) < self.num_towers:
+                    continue
+
+                self.profiler.add('data', data_wait)
+
+                with self.profiler.phase('feed'):
+                    feed_dic = self.feed_dict(batch)
 
                 self.iteration = self.iteration + 1
-                self.sess.run([self.dis_train], feed_dict=feed_dic)
-                self.sess.run([self.gen_train, self.accuracy], feed_dict=feed_dic)
-                self.sess.run([self.gen_train, self.accuracy], feed_dict=feed_dic)
+                run_metadata = self.profiler.run_metadata(self.iteration)
+
+                with self.profiler.phase('run'):
+                    lossD, lossD_fake, lossD_real, lossG, lossG_l1, lossG_gan, acc, step = self.train_step(feed_dic=feed_dic, run_metadata=run_metadata)
 
-                lossD, lossD_fake, lossD_real, lossG, lossG_l1, lossG_gan, acc, step = self.eval_outputs(feed_dic=feed_dic)
+                if run_metadata is not None:
+                    self.profiler.save_trace(run_metadata, step)
 
-                progbar.add(len(input_rgb), values=[
+                progbar.add(len(batch), values=[
                     ("epoch", epoch + 1),
                     ("iter", self.iteration),
                     ("step", step),
@@ -63,46 +187,69 @@ class BaseModel:
                     ("G loss", lossG),
                     ("G L1", lossG_l1),
                     ("G gan", lossG_gan),
-                    ("accuracy", acc)
-                ])
+                    ("accuracy", acc),
+                    ("data wait", data_wait)
+                ] + self.profiler.values())
 
                 # log model at checkpoints
-                if self.options.log and step % self.options.log_interval == 0:
-                    with open(self.train_log_file, 'a') as f:
-                        f.write('%d %d %f %f %f %f %f %f %f\n' % (self.epoch, step, lossD, lossD_fake, lossD_real, lossG, lossG_l1, lossG_gan, acc))
+                log = self.options.log and interval_reached(step, last_step, self.options.log_interval)
+                if log:
+                    with self.profiler.phase('log'):
+                        self.train_log.append(self.epoch, step, lossD, lossD_fake, lossD_real, lossG, lossG_l1, lossG_gan, acc)
 
-                    if self.options.visualize:
-                        visualize(self.train_log_file, self.test_log_file, self.options.visualize_window, self.name)
+                        if self.options.visualize:
+                            visualize(self.train_log, self.test_log, self.name)
 
                 # sample model at checkpoints
-                if self.options.sample and step % self.options.sample_interval == 0:
-                    self.sample(show=False)
+                if self.options.sample and interval_reached(step, last_step, self.options.sample_interval):
+                    with self.profiler.phase('sample'):
+                        self.sample(show=False)
 
                 # validate model at checkpoints
-                if self.options.validate and self.options.validate_interval > 0 and step % self.options.validate_interval == 0:
-                    self.validate()
+                if self.options.validate and interval_reached(step, last_step, self.options.validate_interval):
+                    with self.profiler.phase('validate'):
+                        self.validate()
 
                 # save model at checkpoints
-                if self.options.save and step % self.options.save_interval == 0:
-                    self.save()
+                if self.options.save and interval_reached(step, last_step, self.options.save_interval):
+                    with self.profiler.phase('save'):
+                        self.save(step)
+
+                self.profiler.end_step()
+
+                # mean phase durations of the steps since the previous log
+                if log and self.profiler.enabled:
+                    self.profile_log.append(self.epoch, step, *self.profiler.averages())
+
+                last_step = step
+                data_start = time.time()
 
             if self.options.validate:
                 self.validate()
 
+        self.train_log.close()
+        self.test_log.close()
+        self.profile_log.close()
+
+        # the last checkpoint may still be written in the background
+        if self.checkpoint_saver is not None:
+            self.checkpoint_saver.wait()
+
     def validate(self):
         print('\n\nValidating epoch: %d' % self.epoch)
-        total = len(self.dataset_val)
-        val_generator = self.dataset_val.generator(self.options.batch_size)
-        progbar = Progbar(total, width=25)
+        total = min(self.options.validate_size or len(self.dataset_val), len(self.dataset_val))
+        progbar = Progbar(total, width=25, stateful_metrics=['D loss', 'D fake', 'D real', 'G loss', 'G L1', 'G gan', 'accuracy'])
 
-        for input_rgb in val_generator:
-            feed_dic = {self.input_rgb: input_rgb}
+        # the metrics are averaged in-graph over the whole validation pass
+        self.sess.run(self.val_reset)
 
-            self.sess.run([self.dis_loss, self.gen_loss, self.accuracy], feed_dict=feed_dic)
+        for batch in self.validation_batches(total):
+            if len(batch) < self.num_towers:
+                continue
 
-            lossD, lossD_fake, lossD_real, lossG, lossG_l1, lossG_gan, acc, step = self.eval_outputs(feed_dic=feed_dic)
+            lossD, lossD_fake, lossD_real, lossG, lossG_l1, lossG_gan, acc = self.sess.run(self.val_update, feed_dict=self.feed_dict(batch))
 
-            progbar.add(len(input_rgb), values=[
+            progbar.add(len(batch), values=[
                 ("D loss", lossD),
                 ("D fake", lossD_fake),
                 ("D real", lossD_real),
@@ -114,30 +261,188 @@ class BaseModel:
 
         print('\n')
 
+        if self.options.log:
+            values, step = self.sess.run([self.val_metrics, self.global_step])
+            self.test_log.append(self.epoch, step, *values)
+
+    def validation_batches(self, total):
+        '''
+        yields the batches of the first total valid validation images
+        the decoded images are kept in memory for the next passes if they fit in --validate-cache-mb
+        '''
+        transform = self.input_transform() or (lambda img: img)
+        batch_size = self.options.batch_size
+
+        if self.val_cache is not None:
+            for start in range(0, len(self.val_cache), batch_size):
+                yield [transform(img) for img in self.val_cache[start:start + batch_size]]
+
+            return
+
+        cache = [] if self.options.validate_cache_mb > 0 and not self.val_cache_full else None
+        cache_bytes = 0
+        count = 0
+
+        for batch in self.dataset_val.generator(batch_size, workers=self.options.workers, prefetch=self.options.prefetch):
+            batch = batch[:total - count]
+            count += len(batch)
+
+            if cache is not None:
+                cache.extend(batch)
+                cache_bytes += sum([np.asarray(img).nbytes for img in batch])
+
+                if cache_bytes > self.options.validate_cache_mb * 2**20:
+                    print('\nthe validation images exceed --validate-cache-mb, decoding them on every pass, see --validate-size')
+                    self.val_cache_full = True
+                    cache = None
+
+            yield [transform(img) for img in batch]
+
+            if count >= total:
+                break
+
+        self.val_cache = cache
+
     def test(self):
         print('\nTesting...')
         dataset = TestDataset(self.options.test_input or (self.options.checkpoints_path + '/test'))
         outputs_path = create_dir(self.options.test_output or (self.options.checkpoints_path + '/output'))
+        batch_size = self.test_batch_size()
+        generator = dataset.generator(batch_size, workers=self.options.workers, prefetch=self.options.prefetch)
+
+        # images are read and written on separate threads while the current batch is colorized
+        writer = ThreadPoolExecutor(max_workers=max(1, self.options.workers))
+        pending = collections.deque()
+        count = 0
+        start = time.time()
+
+        for batch in generator:
+            paths = [path for path, _ in batch]
+            outputs = self.colorize_images([img_gray for _, img_gray in batch])
+
+            for img_gray_path, output in zip(paths, outputs):
+                path = os.path.join(outputs_path, os.path.basename(img_gray_path))
+                pending.append(writer.submit(imsave, output, path))
+                print(path)
+
+            count += len(batch)
+
+            while len(pending) > self.options.prefetch * batch_size:
+                pending.popleft().result()
+
+        for future in pending:
+            future.result()
 
-        for index in range(len(dataset)):
-            img_gray_path, img_gray = dataset[index]
-            name = os.path.basename(img_gray_path)
-            path = os.path.join(outputs_path, name)
+        writer.shutdown()
 
-            feed_dic = {self.input_gray: img_gray[None, :, :, None]}
-            outputs = self.sess.run(self.sampler, feed_dict=feed_dic)
-            outputs = postprocess(tf.convert_to_tensor(outputs), colorspace_in=self.options.color_space, colorspace_out=COLORSPACE_RGB).eval() * 255
-            print(path)
-            imsave(outputs[0], path)
+        elapsed = time.time() - start
+        print('\ncolorized %d images in %.2fs (%.2f images/sec)' % (count, elapsed, count / max(elapsed, 1e-6)))
+
+    def generator_stride(self):
+        '''
+        returns the product of the generator encoder strides, the input sizes must be divisible by it
+        '''
+        if self._generator_stride is None:
+            self._generator_stride = int(np.prod([kernel[1] for kernel in self.create_generator().encoder_kernels]))
+
+        return self._generator_stride
+
+    def batch_independent(self):
+        '''
+        returns whether the outputs of an image do not depend on the other images of its batch: the sampler
+        normalizes with the batch statistics unless the moving statistics are used (--inference-bn or an exported model)
+        '''
+        return bool(self.options.inference_bn or self.options.frozen_model or self.options.quantized_model)
+
+    def test_batch_size(self):
+        '''
+        returns the number of images or tiles to colorize at once, one unless the outputs are batch independent
+        '''
+        return self.options.test_batch_size if self.batch_independent() else 1
+
+    def predict(self, inputs):
+        '''
+        runs the generator on a batch of grayscale images
+        returns the outputs in the model color space
+        '''
+        if self.interpreter is None:
+            return self.sess.run(self.sampler, feed_dict={self.input_gray: inputs})
+
+        return run_interpreter(self.interpreter, inputs)
+
+    def colorize(self, inputs):
+        '''
+        colorizes a batch of same-sized grayscale images
+        returns the RGB uint8 images
+        '''
+        if self.interpreter is None:
+            return self.sess.run(self.sampler_rgb, feed_dict={self.input_gray: inputs})
+
+        return self.sess.run(self.output_rgb, feed_dict={self.output_color: self.predict(inputs)})
+
+    def colorize_images(self, images):
+        '''
+        colorizes a list of same-sized grayscale images, in tiles if enabled
+        returns the RGB uint8 images
+        '''
+        # the quantized generator has a fixed input size, other sizes are colorized in tiles of that size
+        quantized_tiles = self.interpreter is not None and images[0].shape[:2] != tuple(self.interpreter_input['shape'][1:3])
+
+        if self.options.tile_size > 0 or quantized_tiles:
+            return [self.colorize_tiled(img_gray) for img_gray in images]
+
+        return self.colorize(np.stack(images)[:, :, :, None])
+
+    def colorize_tiled(self, img_gray):
+        '''
+        colorizes a grayscale image of any size in overlapping tiles, the tile predictions are blended
+        with weights that fall off linearly towards the tile borders
+        returns the RGB uint8 image
+        '''
+        height, width = img_gray.shape[:2]
+
+        stride = self.generator_stride()
+        tile = int(np.ceil(float(self.options.tile_size) / stride) * stride)
+
+        # the quantized generator input size is fixed
+        if self.interpreter is not None:
+            tile = int(self.interpreter_input['shape'][1])
+        overlap = min(self.options.tile_overlap, tile // 2)
+        step = tile - overlap
+
+        # pad the image to be exactly covered by the tiles
+        padded_height = tile + int(np.ceil(max(height - tile, 0) / float(step))) * step
+        padded_width = tile + int(np.ceil(max(width - tile, 0) / float(step))) * step
+        img = np.pad(img_gray, ((0, padded_height - height), (0, padded_width - width)), mode='symmetric')
+
+        ramp = np.minimum(np.arange(tile) + 0.5, np.arange(tile)[::-1] + 0.5) / max(overlap, 1)
+        ramp = np.minimum(ramp, 1.0)
+        weights = np.outer(ramp, ramp)[:, :, None]
+
+        output = np.zeros((padded_height, padded_width, 3))
+        total = np.zeros((padded_height, padded_width, 1))
+        positions = [(y, x) for y in range(0, padded_height - tile + 1, step) for x in range(0, padded_width - tile + 1, step)]
+
+        batch_size = self.test_batch_size()
+        for start in range(0, len(positions), batch_size):
+            batch = positions[start:start + batch_size]
+            tiles = np.stack([img[y:y + tile, x:x + tile] for y, x in batch])[:, :, :, None]
+            preds = self.predict(tiles)
+
+            for (y, x), pred in zip(batch, preds):
+                output[y:y + tile, x:x + tile] += pred * weights
+                total[y:y + tile, x:x + tile] += weights
+
+        output = (output / total)[:height, :width]
+        return self.sess.run(self.output_rgb, feed_dict={self.output_color: output[None]})[0]
 
     def sample(self, show=True):
         input_rgb = next(self.sample_generator)
-        feed_dic = {self.input_rgb: input_rgb}
+        feed_dic = self.feed_rgb(input_rgb)
 
         step, rate = self.sess.run([self.global_step, self.learning_rate])
-        fake_image, input_gray = self.sess.run([self.sampler, self.input_gray], feed_dict=feed_dic)
-        fake_image = postprocess(tf.convert_to_tensor(fake_image), colorspace_in=self.options.color_space, colorspace_out=COLORSPACE_RGB)
-        img = stitch_images(input_gray, input_rgb, fake_image.eval())
+        fake_image, input_gray = self.sess.run([self.sampler_rgb, self.input_gray], feed_dict=feed_dic)
+        img = stitch_images(input_gray, input_rgb, fake_image)
 
         create_dir(self.samples_dir)
         sample = self.options.dataset + "_" + str(step).zfill(5) + ".png"
@@ -150,22 +455,46 @@ class BaseModel:
 
     def turing_test(self):
         batch_size = self.options.batch_size
-        gen = self.dataset_val.generator(batch_size, True)
-        count = 0
-        score = 0
         size = self.options.turing_test_size
+        pairs = queue.Queue()
+
+        # pairs are generated on a background thread, ahead of the judge
+        def produce():
+            try:
+                gen = self.dataset_val.generator(batch_size, True, workers=self.options.workers, prefetch=self.options.prefetch)
+                real_imgs = []
+                fake_imgs = []
+
+                while len(real_imgs) < size:
+                    input_rgb = next(gen)
+                    feed_dic = self.feed_rgb(input_rgb)
+                    fake_image = self.sess.run(self.sampler_rgb, feed_dict=feed_dic)
+
+                    for i in range(np.min([len(input_rgb), size - len(real_imgs)])):
+                        real_imgs.append(np.array(input_rgb[i], dtype=np.uint8))
+                        fake_imgs.append(fake_image[i])
+                        pairs.put((real_imgs[-1], fake_imgs[-1]))
+
+                if self.options.turing_test_pairs:
+                    save_turing_pairs(self.options.turing_test_pairs, real_imgs, fake_imgs)
 
-        while count < size:
-            input_rgb = next(gen)
-            feed_dic = {self.input_rgb: input_rgb}
-            fake_image = self.sess.run(self.sampler, feed_dict=feed_dic)
-            fake_image = postprocess(tf.convert_to_tensor(fake_image), colorspace_in=self.options.color_space, colorspace_out=COLORSPACE_RGB)
+            except Exception as e:
+                pairs.put(e)
 
-            for i in range(np.min([batch_size, size - count])):
-                res = turing_test(input_rgb[i], fake_image.eval()[i], self.options.turing_test_delay)
-                count += 1
-                score += res
-                print('success: %d - fail: %d - rate: %f' % (score, count - score, (count - score) / count))
+        def consume():
+            for _ in range(size):
+                pair = pairs.get()
+                if isinstance(pair, Exception):
+                    raise pair
+
+                yield pair
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+
+        run_turing_test(consume(), self.options.turing_test_delay)
+        producer.join()
 
     def build(self):
         if self.is_built:
@@ -173,44 +502,89 @@ class BaseModel:
 
         self.is_built = True
 
+        # test and serve modes: run the quantized generator
+        inference = self.options.mode in (1, 5)
+        if inference and self.options.quantized_model:
+            self.build_quantized()
+            return
+
+        # test and serve modes: run the exported generator-only graph instead of the full model
+        if inference and self.options.frozen_model:
+            self.build_frozen()
+            return
+
+        # test and serve modes: only the generator is built and restored
+        if inference:
+            self.build_inference()
+            return
+
         gen_factory = self.create_generator()
         dis_factory = self.create_discriminator()
-        smoothing = 0.9 if self.options.label_smoothing else 1
         seed = self.options.seed
         kernel = 4
 
         # model input placeholder: RGB imaege
         self.input_rgb = tf.placeholder(tf.float32, shape=(None, None, None, 3), name='input_rgb')
 
-        # model input after preprocessing: LAB image
-        self.input_color = preprocess(self.input_rgb, colorspace_in=COLORSPACE_RGB, colorspace_out=self.options.color_space)
-
-        # test mode: model input is a graycale placeholder
-        if self.options.mode == 1:
+        # host preprocessing: the data loading workers feed the grayscale and LAB images, see host_preprocess
+        if self.options.host_preprocess:
+            self.input_color = tf.placeholder(tf.float32, shape=(None, None, None, 3), name='input_color')
             self.input_gray = tf.placeholder(tf.float32, shape=(None, None, None, 1), name='input_gray')
 
-        # train/turing-test we extract grayscale image from color image
         else:
+            # model input after preprocessing: LAB image
+            self.input_color = preprocess(self.input_rgb, colorspace_in=COLORSPACE_RGB, colorspace_out=self.options.color_space, lut=self.options.color_lut)
+
+            # train/turing-test we extract grayscale image from color image
             self.input_gray = tf.image.rgb_to_grayscale(self.input_rgb)
 
-        gen = gen_factory.create(self.input_gray, kernel, seed)
-        dis_real = dis_factory.create(tf.concat([self.input_gray, self.input_color], 3), kernel, seed)
-        dis_fake = dis_factory.create(tf.concat([self.input_gray, gen], 3), kernel, seed, reuse_variables=True)
+        devices = self.devices()
+        self.num_towers = len(devices)
 
-        gen_ce = tf.nn.sigmoid_cross_entropy_with_logits(logits=dis_fake, labels=tf.ones_like(dis_fake))
-        dis_real_ce = tf.nn.sigmoid_cross_entropy_with_logits(logits=dis_real, labels=tf.ones_like(dis_real) * smoothing)
-        dis_fake_ce = tf.nn.sigmoid_cross_entropy_with_logits(logits=dis_fake, labels=tf.zeros_like(dis_fake))
+        # data-parallel towers: each device gets a slice of the batch, variables are shared
+        if len(devices) > 1:
+            batch_size = tf.shape(self.input_gray)[0]
+            split_sizes = batch_size // len(devices) + tf.cast(tf.range(len(devices)) < batch_size % len(devices), tf.int32)
+            inputs_gray = tf.split(self.input_gray, split_sizes, num=len(devices))
+            inputs_color = tf.split(self.input_color, split_sizes, num=len(devices))
+            towers = []
 
-        self.dis_loss_real = tf.reduce_mean(dis_real_ce)
-        self.dis_loss_fake = tf.reduce_mean(dis_fake_ce)
-        self.dis_loss = tf.reduce_mean(dis_real_ce + dis_fake_ce)
+            for index, device in enumerate(devices):
+                with tf.device(device), tf.name_scope('tower_%d' % index):
+                    towers.append(self.build_tower(gen_factory, dis_factory, inputs_gray[index], inputs_color[index], reuse_variables=index > 0))
 
-        self.gen_loss_gan = tf.reduce_mean(gen_ce)
-        self.gen_loss_l1 = tf.reduce_mean(tf.abs(self.input_color - gen)) * self.options.l1_weight
+        else:
+            towers = [self.build_tower(gen_factory, dis_factory, self.input_gray, self.input_color)]
+
+        self.dis_loss_real = average_towers([tower['dis_loss_real'] for tower in towers])
+        self.dis_loss_fake = average_towers([tower['dis_loss_fake'] for tower in towers])
+        self.dis_loss = average_towers([tower['dis_loss'] for tower in towers])
+
+        self.gen_loss_gan = average_towers([tower['gen_loss_gan'] for tower in towers])
+        self.gen_loss_l1 = average_towers([tower['gen_loss_l1'] for tower in towers])
         self.gen_loss = self.gen_loss_gan + self.gen_loss_l1
 
-        self.sampler = tf.identity(gen_factory.create(self.input_gray, kernel, seed, reuse_variables=True), name='output')
-        self.accuracy = pixelwise_accuracy(self.input_color, gen, self.options.color_space, self.options.acc_thresh)
+        # sampler: with inference batch-norm, the output does not depend on the batch composition
+        sampler = gen_factory.create(self.input_gray, kernel, seed, reuse_variables=True, bn_training=not self.options.inference_bn)
+        self.sampler = tf.identity(sampler, name='output')
+
+        # sampler output converted to an RGB uint8 image
+        self.sampler_rgb = self.to_rgb_uint8(self.sampler, name='output_rgb')
+        self.build_output()
+        self.accuracy = average_towers([tower['accuracy'] for tower in towers])
+
+        # streaming validation means weighted by the batch sizes, in TEST_LOG_COLUMNS order
+        with tf.variable_scope('validation'):
+            weights = tf.cast(tf.shape(self.input_gray)[0], tf.float32)
+            metrics = [
+                tf.metrics.mean(value, weights=weights)
+                for value in [self.dis_loss, self.dis_loss_fake, self.dis_loss_real, self.gen_loss, self.gen_loss_l1, self.gen_loss_gan, self.accuracy]
+            ]
+
+            self.val_metrics = [metric for metric, _ in metrics]
+            self.val_update = [update for _, update in metrics]
+            self.val_reset = tf.variables_initializer(tf.local_variables(scope='validation'))
+
         self.learning_rate = tf.constant(self.options.lr)
 
         # learning rate decay
@@ -221,51 +595,394 @@ class BaseModel:
                 decay_steps=self.options.lr_decay_steps,
                 decay_rate=self.options.lr_decay_rate))
 
+        gen_optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate, beta1=self.options.beta1)
+        dis_optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate / 10, beta1=self.options.beta1)
+
+        # per-tower gradients are computed on the tower device and averaged
+        gen_grads = []
+        dis_grads = []
+        for device, tower in zip(devices, towers):
+            with tf.device(device):
+                gen_grads.append(gen_optimizer.compute_gradients(tower['gen_loss'], var_list=gen_factory.var_list, colocate_gradients_with_ops=True))
+                dis_grads.append(dis_optimizer.compute_gradients(tower['dis_loss'], var_list=dis_factory.var_list, colocate_gradients_with_ops=True))
+
+        # moving batch-norm statistics of the first training tower are updated along with the optimizers
+        scope = 'tower_0/' if len(devices) > 1 else ''
+        gen_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope + gen_factory.name + '/')
+        dis_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope + dis_factory.name + '/')
+
         # generator optimizaer
-        self.gen_train = tf.train.AdamOptimizer(
-            learning_rate=self.learning_rate,
-            beta1=self.options.beta1
-        ).minimize(self.gen_loss, var_list=gen_factory.var_list)
+        with tf.control_dependencies(gen_update_ops):
+            self.gen_train = gen_optimizer.apply_gradients(average_gradients(gen_grads))
 
         # discriminator optimizaer
-        self.dis_train = tf.train.AdamOptimizer(
-            learning_rate=self.learning_rate / 10,
-            beta1=self.options.beta1
-        ).minimize(self.dis_loss, var_list=dis_factory.var_list, global_step=self.global_step)
+        with tf.control_dependencies(dis_update_ops):
+            self.dis_train = dis_optimizer.apply_gradients(average_gradients(dis_grads), global_step=self.global_step)
 
-        self.saver = tf.train.Saver()
+        # training state saved with the checkpoints: epoch, iteration and image position within the epoch, data order seed
+        model_variables = tf.global_variables()
+        self.train_state = tf.Variable(np.array([0, 0, 0, self.options.seed]), dtype=tf.int64, name='train_state', trainable=False)
+        self.train_state_input = tf.placeholder(tf.int64, shape=(4,))
+        self.train_state_assign = tf.assign(self.train_state, self.train_state_input)
+
+        keep_hours = self.options.keep_checkpoint_hours or 10000.0
+        self.saver = tf.train.Saver(max_to_keep=self.options.keep_checkpoints, keep_checkpoint_every_n_hours=keep_hours)
+
+        # checkpoints written before the training state was saved
+        self.model_saver = tf.train.Saver(model_variables)
+
+        if self.options.async_save:
+            self.checkpoint_saver = AsyncCheckpointSaver(self.sess, tf.global_variables(), self.options.keep_checkpoints, keep_hours)
+
+    def build_tower(self, gen_factory, dis_factory, input_gray, input_color, reuse_variables=None):
+        '''
+        builds the generator, discriminator, losses and accuracy for one slice of the batch
+        '''
+        smoothing = 0.9 if self.options.label_smoothing else 1
+        seed = self.options.seed
+        kernel = 4
+
+        gen = gen_factory.create(input_gray, kernel, seed, reuse_variables=reuse_variables)
+        dis_real = dis_factory.create(tf.concat([input_gray, input_color], 3), kernel, seed, reuse_variables=reuse_variables)
+        dis_fake = dis_factory.create(tf.concat([input_gray, gen], 3), kernel, seed, reuse_variables=True)
+
+        gen_ce = tf.nn.sigmoid_cross_entropy_with_logits(logits=dis_fake, labels=tf.ones_like(dis_fake))
+        dis_real_ce = tf.nn.sigmoid_cross_entropy_with_logits(logits=dis_real, labels=tf.ones_like(dis_real) * smoothing)
+        dis_fake_ce = tf.nn.sigmoid_cross_entropy_with_logits(logits=dis_fake, labels=tf.zeros_like(dis_fake))
+
+        tower = {
+            'dis_loss_real': tf.reduce_mean(dis_real_ce),
+            'dis_loss_fake': tf.reduce_mean(dis_fake_ce),
+            'dis_loss': tf.reduce_mean(dis_real_ce + dis_fake_ce),
+            'gen_loss_gan': tf.reduce_mean(gen_ce),
+            'gen_loss_l1': tf.reduce_mean(tf.abs(input_color - gen)) * self.options.l1_weight,
+            'accuracy': pixelwise_accuracy(input_color, gen, self.options.color_space, self.options.acc_thresh, lut=self.options.color_lut)
+        }
+
+        tower['gen_loss'] = tower['gen_loss_gan'] + tower['gen_loss_l1']
+        return tower
+
+    def devices(self):
+        '''
+        returns the devices to build the training towers on, [None] for a single default-placed tower
+        '''
+        if self.options.cpu_towers > 1:
+            return ['/cpu:%d' % index for index in range(self.options.cpu_towers)]
+
+        gpu_ids = [gpu_id for gpu_id in self.options.gpu_ids.split(',') if int(gpu_id) >= 0]
+        if len(gpu_ids) > 1:
+            # CUDA_VISIBLE_DEVICES renumbers the visible devices from zero
+            return ['/gpu:%d' % index for index in range(len(gpu_ids))]
+
+        return [None]
+
+    def build_inference(self):
+        gen_factory = self.create_generator()
+
+        # model input placeholder: graycale image
+        self.input_gray = tf.placeholder(tf.float32, shape=(None, None, None, 1), name='input_gray')
+
+        sampler = gen_factory.create(self.input_gray, 4, self.options.seed, bn_training=not self.options.inference_bn)
+        self.sampler = tf.identity(sampler, name='output')
+        self.sampler_rgb = self.to_rgb_uint8(self.sampler, name='output_rgb')
+        self.build_output()
+
+        # the discriminator and optimizer variables of the checkpoints are not restored
+        self.saver = tf.train.Saver([var for var in tf.global_variables() if var.name.startswith(gen_factory.name + '/')])
+        self.model_saver = self.saver
+
+    def build_frozen(self):
+        graph_def = tf.GraphDef()
+        with open(self.options.frozen_model, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.input_gray, self.sampler, self.sampler_rgb = tf.import_graph_def(
+            graph_def,
+            return_elements=['input_gray:0', 'output:0', 'output_rgb:0'],
+            name='frozen')
+
+        self.saver = None
+        self.build_output()
+
+    def build_quantized(self):
+        self.interpreter = tf.lite.Interpreter(model_path=self.options.quantized_model, num_threads=os.cpu_count())
+        self.interpreter.allocate_tensors()
+        self.interpreter_input = self.interpreter.get_input_details()[0]
+        self.saver = None
+        self.build_output()
+
+    def build_output(self):
+        # model color space output placeholder (e.g. blended tiles) converted to an RGB uint8 image
+        self.output_color = tf.placeholder(tf.float32, shape=(None, None, None, 3), name='output_color')
+        self.output_rgb = self.to_rgb_uint8(self.output_color)
+
+    def to_rgb_uint8(self, tensor, name=None):
+        '''
+        converts a model color space tensor in [-1, 1] to an RGB uint8 image
+        '''
+        rgb = postprocess(tensor, colorspace_in=self.options.color_space, colorspace_out=COLORSPACE_RGB, lut=self.options.color_lut)
+        return tf.saturate_cast(rgb * 255, tf.uint8, name=name)
+
+    def generator_weights(self):
+        '''
+        returns the generator factory and the values of the generator variables by name
+        '''
+        gen_factory = self.create_generator()
+        variables = [var for var in tf.global_variables() if var.name.startswith(gen_factory.name + '/')]
+        weights = dict(zip([var.name.split(':')[0] for var in variables], self.sess.run(variables)))
+
+        # checkpoints trained before the batch-norm update ops were run still hold the initial moving statistics
+        means = [value for name, value in weights.items() if name.endswith('/moving_mean')]
+        variances = [value for name, value in weights.items() if name.endswith('/moving_variance')]
+        if means and all(np.all(mean == 0) for mean in means) and all(np.all(variance == 1) for variance in variances):
+            raise RuntimeError('the moving batch-norm statistics of the checkpoint were never updated, the generator cannot be folded with them')
+
+        return gen_factory, weights
+
+    def export(self):
+        '''
+        exports the generator as a frozen inference graph with batch-norm folded into the convolutions
+        the exported outputs are checked against the restored generator using the moving batch-norm statistics
+        '''
+        path = self.options.frozen_model or os.path.join(self.options.checkpoints_path, 'frozen_gen.pb')
+        gen_factory, weights = self.generator_weights()
+
+        size = 2 * self.generator_stride()
+        inputs = np.random.uniform(0, 255, (2, size, size, 1))
+
+        # reference: the checkpoint generator graph, in the model session
+        reference_input = tf.placeholder(tf.float32, shape=(None, None, None, 1))
+        reference = gen_factory.create(reference_input, 4, self.options.seed, reuse_variables=True, bn_training=False)
+        expected = self.sess.run(reference, feed_dict={reference_input: inputs})
+
+        graph = tf.Graph()
+        with graph.as_default():
+            input_gray = tf.placeholder(tf.float32, shape=(None, None, None, 1), name='input_gray')
+            sampler = tf.identity(gen_factory.create_frozen(input_gray, weights), name='output')
+            self.to_rgb_uint8(sampler, name='output_rgb')
+
+            with tf.Session(graph=graph) as sess:
+                outputs = sess.run(sampler, feed_dict={input_gray: inputs})
+
+            graph_def = tf.graph_util.extract_sub_graph(graph.as_graph_def(), ['output', 'output_rgb'])
+
+        diff = np.max(np.abs(outputs - expected))
+        if diff > EXPORT_TOLERANCE:
+            raise RuntimeError('the exported generator outputs differ from the checkpoint generator by %e (tolerance: %e)' % (diff, EXPORT_TOLERANCE))
+
+        tf.train.write_graph(graph_def, os.path.dirname(path) or '.', os.path.basename(path), as_text=False)
+        print('frozen model saved to %s - max abs difference: %e (tolerance: %e)' % (path, diff, EXPORT_TOLERANCE))
+
+        return path
+
+    def quantize(self):
+        '''
+        converts the generator, batch-norm folded, to an int8 TensorFlow Lite model calibrated on validation images
+        the latency, size and accuracy on held-out validation images are compared to the folded fp32 generator
+        returns the quantization report
+        '''
+        path = self.options.quantized_model or os.path.join(self.options.checkpoints_path, 'gen_int8.tflite')
+        gen_factory, weights = self.generator_weights()
+
+        # the first half calibrates the quantization ranges, the second half is held out for evaluation
+        # the quantized model has the input size of the first image, images of other sizes are skipped
+        images = []
+        shape = None
+        for batch in self.dataset_val.generator(self.options.test_batch_size):
+            for img in batch:
+                shape = shape or img.shape
+                if img.shape == shape:
+                    images.append(img)
+
+            if len(images) >= 2 * self.options.quantize_samples:
+                break
+
+        calibration = images[:len(images) // 2]
+        evaluation = images[len(images) // 2:]
+        height, width = images[0].shape[:2]
+
+        graph = tf.Graph()
+        with graph.as_default(), tf.Session(graph=graph) as sess:
+            input_gray = tf.placeholder(tf.float32, shape=(None, height, width, 1), name='input_gray')
+            sampler = tf.identity(gen_factory.create_frozen(input_gray, weights), name='output')
+
+            img_real = tf.placeholder(tf.float32, shape=(None, height, width, 3))
+            img_fake = tf.placeholder(tf.float32, shape=(None, height, width, 3))
+            accuracy = pixelwise_accuracy(img_real, img_fake, self.options.color_space, self.options.acc_thresh, lut=self.options.color_lut)
+
+            def representative_dataset():
+                for img in calibration:
+                    yield [color.rgb_to_grayscale(img)[None].astype(np.float32)]
+
+            converter = tf.lite.TFLiteConverter.from_session(sess, [input_gray], [sampler])
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = representative_dataset
+
+            # ops without an int8 kernel fall back to float
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+            model = converter.convert()
+
+            with open(path, 'wb') as f:
+                f.write(model)
+
+            interpreter = tf.lite.Interpreter(model_content=model, num_threads=os.cpu_count())
+            fp32_size = len(tf.graph_util.extract_sub_graph(graph.as_graph_def(), ['output']).SerializeToString())
+
+            fp32_acc = []
+            int8_acc = []
+            for start in range(0, len(evaluation), self.options.test_batch_size):
+                batch = evaluation[start:start + self.options.test_batch_size]
+                inputs = np.stack([color.rgb_to_grayscale(img) for img in batch])
+                real = np.stack([color.preprocess(img, COLORSPACE_RGB, self.options.color_space) for img in batch])
+
+                fake = sess.run(sampler, feed_dict={input_gray: inputs})
+                fp32_acc.append(sess.run(accuracy, feed_dict={img_real: real, img_fake: fake}) * len(batch))
+
+                fake = run_interpreter(interpreter, inputs)
+                int8_acc.append(sess.run(accuracy, feed_dict={img_real: real, img_fake: fake}) * len(batch))
+
+            inputs = color.rgb_to_grayscale(evaluation[0])[None]
+            fp32_latency = median_time(lambda: sess.run(sampler, feed_dict={input_gray: inputs}))
+            int8_latency = median_time(lambda: run_interpreter(interpreter, inputs))
+
+        report = {
+            'fp32_size': fp32_size,
+            'int8_size': len(model),
+            'fp32_latency': fp32_latency,
+            'int8_latency': int8_latency,
+            'fp32_accuracy': np.sum(fp32_acc) / max(1, len(evaluation)),
+            'int8_accuracy': np.sum(int8_acc) / max(1, len(evaluation)),
+        }
+
+        print('quantized model saved to %s - calibration images: %d - evaluation images: %d' % (path, len(calibration), len(evaluation)))
+        print('size: fp32: %.2fMB - int8: %.2fMB' % (report['fp32_size'] / 2.0**20, report['int8_size'] / 2.0**20))
+        print('latency, batch size 1, %dx%d: fp32: %.2fms - int8: %.2fms' % (height, width, report['fp32_latency'] * 1e3, report['int8_latency'] * 1e3))
+        print('accuracy: fp32: %.4f - int8: %.4f - change: %+.4f' % (report['fp32_accuracy'], report['int8_accuracy'], report['int8_accuracy'] - report['fp32_accuracy']))
+
+        return report
 
     def load(self):
+        if self.saver is None:
+            return False
+
         ckpt = tf.train.get_checkpoint_state(self.options.checkpoints_path)
         if ckpt is not None:
             print('loading model...\n')
             ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
-            self.saver.restore(self.sess, os.path.join(self.options.checkpoints_path, ckpt_name))
+
+            try:
+                self.saver.restore(self.sess, os.path.join(self.options.checkpoints_path, ckpt_name))
+            except tf.errors.NotFoundError:
+                print('the checkpoint has no training state, training restarts at the first epoch\n')
+                self.model_saver.restore(self.sess, os.path.join(self.options.checkpoints_path, ckpt_name))
+
+                # the global initializer is skipped when a checkpoint is restored, see main
+                self.sess.run(self.train_state.initializer)
+
+            self.saver.recover_last_checkpoints(ckpt.all_model_checkpoint_paths)
             return True
 
         return False
 
-    def save(self):
-        print('saving model...\n')
-        self.saver.save(self.sess, os.path.join(self.options.checkpoints_path, 'CGAN_' + self.options.dataset), write_meta_graph=False)
+    def save(self, step=None):
+        path = os.path.join(self.options.checkpoints_path, 'CGAN_' + self.options.dataset)
+        step = self.sess.run(self.global_step) if step is None else step
+
+        state = [max(0, self.epoch - 1), self.iteration, self.dataset_train.position, self.dataset_train.seed or 0]
+        self.sess.run(self.train_state_assign, feed_dict={self.train_state_input: state})
+
+        if self.checkpoint_saver is None:
+            print('saving model...\n')
+            self.saver.save(self.sess, path, global_step=step, write_meta_graph=False)
+            return
+
+        # training only waits for the previous write and for the variables to be copied
+        stall = self.checkpoint_saver.save(path, step)
+        print('saving model... - stalled: %.3fs - last write: %.3fs\n' % (stall, self.checkpoint_saver.last_write_time))
+
+    def host_preprocess(self, img):
+        '''
+        converts an RGB image to the model inputs on the host, to be run by the data loading workers
+        returns (grayscale image, normalized color image)
+        '''
+        return color.rgb_to_grayscale(img), color.preprocess(img, colorspace_in=COLORSPACE_RGB, colorspace_out=self.options.color_space)
+
+    def input_transform(self):
+        return self.host_preprocess if self.options.host_preprocess else None
+
+    def feed_dict(self, batch):
+        '''
+        returns the feed dictionary of a batch of RGB images, or of (grayscale, color) pairs when preprocessed on the host
+        '''
+        if self.options.host_preprocess:
+            return {
+                self.input_gray: np.stack([img_gray for img_gray, _ in batch]),
+                self.input_color: np.stack([img_color for _, img_color in batch])
+            }
+
+        return {self.input_rgb: batch}
 
-    def eval_outputs(self, feed_dic):
+    def feed_rgb(self, input_rgb):
         '''
-        evaluates the loss and accuracy
+        returns the feed dictionary of a batch of RGB images, preprocessed on the host if enabled
+        '''
+        if self.options.host_preprocess:
+            return self.feed_dict([self.host_preprocess(img) for img in input_rgb])
+
+        return {self.input_rgb: input_rgb}
+
+    def train_step(self, feed_dic, run_metadata=None):
+        '''
+        runs the discriminator and generator updates on a single batch
+        in fused mode, the losses and accuracy are fetched with the last update op
         returns (D loss, D_fake loss, D_real loss, G loss, G_L1 loss, G_gan loss, accuracy, step)
         '''
-        lossD_fake = self.dis_loss_fake.eval(feed_dict=feed_dic)
-        lossD_real = self.dis_loss_real.eval(feed_dict=feed_dic)
-        lossD = self.dis_loss.eval(feed_dict=feed_dic)
+        ops = [self.dis_train] * self.options.dis_steps + [self.gen_train] * self.options.gen_steps
+
+        if not self.options.fused_step or len(ops) == 0:
+            for op in ops:
+                self.run(op, feed_dic, run_metadata)
 
-        lossG_l1 = self.gen_loss_l1.eval(feed_dict=feed_dic)
-        lossG_gan = self.gen_loss_gan.eval(feed_dict=feed_dic)
-        lossG = lossG_l1 + lossG_gan
+            return self.eval_outputs(feed_dic=feed_dic, run_metadata=run_metadata)
 
-        acc = self.accuracy.eval(feed_dict=feed_dic)
-        step = self.sess.run(self.global_step)
+        for op in ops[:-1]:
+            self.run(op, feed_dic, run_metadata)
 
-        return lossD, lossD_fake, lossD_real, lossG, lossG_l1, lossG_gan, acc, step
+        return self.eval_outputs(feed_dic=feed_dic, ops=ops[-1:], run_metadata=run_metadata)
+
+    def run(self, fetches, feed_dic, run_metadata=None):
+        '''
+        runs the fetches, fully traced into run_metadata if given
+        '''
+        if run_metadata is None:
+            return self.sess.run(fetches, feed_dict=feed_dic)
+
+        # the step stats of all the runs of a step are merged into a single timeline
+        metadata = tf.RunMetadata()
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        outputs = self.sess.run(fetches, feed_dict=feed_dic, options=options, run_metadata=metadata)
+        run_metadata.MergeFrom(metadata)
+
+        return outputs
+
+    def eval_outputs(self, feed_dic, ops=None, run_metadata=None):
+        '''
+        evaluates the loss and accuracy in a single session run, optionally along with the given ops
+        returns (D loss, D_fake loss, D_real loss, G loss, G_L1 loss, G_gan loss, accuracy, step)
+        '''
+        fetches = [
+            self.dis_loss,
+            self.dis_loss_fake,
+            self.dis_loss_real,
+            self.gen_loss,
+            self.gen_loss_l1,
+            self.gen_loss_gan,
+            self.accuracy,
+            self.global_step
+        ]
+
+        outputs = self.run(fetches + list(ops or []), feed_dic, run_metadata)
+        return tuple(outputs[:len(fetches)])
 
     @abstractmethod
     def create_generator(self):
@@ -300,7 +1017,7 @@ class Cifar10Model(BaseModel):
             (64, 2, 0),     # [batch, 16, 16, 128] => [batch, 32, 32, 64]
         ]
 
-        return Generator('gen', kernels_gen_encoder, kernels_gen_decoder, training=self.options.training)
+        return Generator('gen', kernels_gen_encoder, kernels_gen_decoder, training=self.options.training, fused_bn=self.options.fused_bn, data_format=self.options.data_format)
 
     def create_discriminator(self):
         kernels_dis = [
@@ -310,7 +1027,7 @@ class Cifar10Model(BaseModel):
             (512, 1, 0),    # [batch, 4, 4, 256] => [batch, 4, 4, 512]
         ]
 
-        return Discriminator('dis', kernels_dis, training=self.options.training)
+        return Discriminator('dis', kernels_dis, training=self.options.training, fused_bn=self.options.fused_bn, data_format=self.options.data_format)
 
     def create_dataset(self, training=True):
         return Cifar10Dataset(
@@ -345,7 +1062,7 @@ class Places365Model(BaseModel):
             (64, 2, 0)      # [batch, 128, 128, 64] => [batch, 256, 256, 64]
         ]
 
-        return Generator('gen', kernels_gen_encoder, kernels_gen_decoder, training=self.options.training)
+        return Generator('gen', kernels_gen_encoder, kernels_gen_decoder, training=self.options.training, fused_bn=self.options.fused_bn, data_format=self.options.data_format)
 
     def create_discriminator(self):
         kernels_dis = [
@@ -355,10 +1072,19 @@ class Places365Model(BaseModel):
             (512, 1, 0),    # [batch, 32, 32, 256] => [batch, 32, 32, 512]
         ]
 
-        return Discriminator('dis', kernels_dis, training=self.options.training)
+        return Discriminator('dis', kernels_dis, training=self.options.training, fused_bn=self.options.fused_bn, data_format=self.options.data_format)
 
     def create_dataset(self, training=True):
+        if self.options.packed_path:
+            return PackedDataset(
+                name=PLACES365_DATASET,
+                path=os.path.join(self.options.packed_path, 'train' if training else 'val'),
+                training=training,
+                augment=self.options.augment)
+
         return Places365Dataset(
             path=self.options.dataset_path,
             training=training,
-            augment=self.options.augment)
+            augment=self.options.augment,
+            skip_near_grayscale=self.options.skip_near_grayscale,
+            workers=self.options.workers)
@@ -1,17 +1,39 @@
 import numpy as np
 import tensorflow as tf
-from .ops import conv2d, conv2d_transpose, pixelwise_accuracy
+from .ops import conv2d, conv2d_transpose, conv2d_frozen, conv2d_transpose_frozen, pixelwise_accuracy
+
+
+def to_data_format(inputs, data_format):
+    # NHWC => NCHW
+    if data_format == 'channels_first':
+        return tf.transpose(inputs, [0, 3, 1, 2])
+
+    return inputs
+
+
+def from_data_format(inputs, data_format):
+    # NCHW => NHWC
+    if data_format == 'channels_first':
+        return tf.transpose(inputs, [0, 2, 3, 1])
+
+    return inputs
 
 
 class Discriminator(object):
-    def __init__(self, name, kernels, training=True):
+    def __init__(self, name, kernels, training=True, fused_bn=None, data_format='channels_last'):
         self.name = name
         self.kernels = kernels
         self.training = training
+        self.fused_bn = fused_bn
+        self.data_format = data_format
         self.var_list = []
 
-    def create(self, inputs, kernel_size=None, seed=None, reuse_variables=None):
-        output = inputs
+    def create(self, inputs, kernel_size=None, seed=None, reuse_variables=None, bn_training=True):
+        """
+        Creates the discriminator, inputs and outputs are channels-last regardless of the data format
+        bn_training=False normalizes with the moving batch-norm statistics
+        """
+        output = to_data_format(inputs, self.data_format)
         with tf.variable_scope(self.name, reuse=reuse_variables):
             for index, kernel in enumerate(self.kernels):
 
@@ -26,7 +48,10 @@ class Discriminator(object):
                     strides=kernel[1],
                     bnorm=bnorm,
                     activation=tf.nn.leaky_relu,
-                    seed=seed
+                    seed=seed,
+                    training=bn_training,
+                    fused=self.fused_bn,
+                    data_format=self.data_format
                 )
 
                 if kernel[2] > 0:
@@ -40,25 +65,33 @@ class Discriminator(object):
                 kernel_size=4,                  # last layer kernel size = 4
                 strides=1,                      # last layer stride = 1
                 bnorm=False,                    # do not use batch-norm for the last layer
-                seed=seed
+                seed=seed,
+                data_format=self.data_format
             )
 
             self.var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, self.name)
 
-            return output
+            return from_data_format(output, self.data_format)
 
 
 class Generator(object):
-    def __init__(self, name, encoder_kernels, decoder_kernels, output_channels=3, training=True):
+    def __init__(self, name, encoder_kernels, decoder_kernels, output_channels=3, training=True, fused_bn=None, data_format='channels_last'):
         self.name = name
         self.encoder_kernels = encoder_kernels
         self.decoder_kernels = decoder_kernels
         self.output_channels = output_channels
         self.training = training
+        self.fused_bn = fused_bn
+        self.data_format = data_format
         self.var_list = []
 
-    def create(self, inputs, kernel_size=None, seed=None, reuse_variables=None):
-        output = inputs
+    def create(self, inputs, kernel_size=None, seed=None, reuse_variables=None, bn_training=True):
+        """
+        Creates the generator, inputs and outputs are channels-last regardless of the data format
+        bn_training=False normalizes with the moving batch-norm statistics
+        """
+        output = to_data_format(inputs, self.data_format)
+        channels_axis = 1 if self.data_format == 'channels_first' else 3
 
         with tf.variable_scope(self.name, reuse=reuse_variables):
 
@@ -75,7 +108,10 @@ class Generator(object):
                     filters=kernel[0],
                     strides=kernel[1],
                     activation=tf.nn.leaky_relu,
-                    seed=seed
+                    seed=seed,
+                    training=bn_training,
+                    fused=self.fused_bn,
+                    data_format=self.data_format
                 )
 
                 # save contracting path layers to be used for skip connections
@@ -96,7 +132,10 @@ class Generator(object):
                     filters=kernel[0],
                     strides=kernel[1],
                     activation=tf.nn.relu,
-                    seed=seed
+                    seed=seed,
+                    training=bn_training,
+                    fused=self.fused_bn,
+                    data_format=self.data_format
                 )
 
                 if kernel[2] > 0:
@@ -104,8 +143,8 @@ class Generator(object):
                     output = tf.nn.dropout(output, keep_prob=keep_prob, name='dropout_' + name, seed=seed)
 
                 # concat the layer from the contracting path with the output of the current layer
-                # concat only the channels (axis=3)
-                output = tf.concat([layers[len(layers) - index - 2], output], axis=3)
+                # concat only the channels
+                output = tf.concat([layers[len(layers) - index - 2], output], axis=channels_axis)
 
             output = conv2d(
                 inputs=output,
@@ -115,9 +154,32 @@ class Generator(object):
                 strides=1,                      # last layer stride = 1
                 bnorm=False,                    # do not use batch-norm for the last layer
                 activation=tf.nn.tanh,          # tanh activation function for the output
-                seed=seed
+                seed=seed,
+                data_format=self.data_format
             )
 
             self.var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, self.name)
 
-            return output
+            return from_data_format(output, self.data_format)
+
+    def create_frozen(self, inputs, weights, fold=True):
+        """
+        Creates an inference-only generator from the given variable values:
+        batch-norm is folded into the preceding convolutions and dropout is removed
+        """
+        output = inputs
+        layers = []
+
+        with tf.name_scope(self.name):
+
+            # encoder branch
+            for index, kernel in enumerate(self.encoder_kernels):
+                output = conv2d_frozen(output, weights, self.name + '/conv' + str(index), strides=kernel[1], activation=tf.nn.leaky_relu, fold=fold)
+                layers.append(output)
+
+            # decoder branch
+            for index, kernel in enumerate(self.decoder_kernels):
+                output = conv2d_transpose_frozen(output, weights, self.name + '/deconv' + str(index), strides=kernel[1], activation=tf.nn.relu, fold=fold)
+                output = tf.concat([layers[len(layers) - index - 2], output], axis=3)
+
+            return conv2d_frozen(output, weights, self.name + '/conv_last', strides=1, activation=tf.nn.tanh, fold=fold)
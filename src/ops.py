@@ -3,11 +3,16 @@ import tensorflow as tf
 
 COLORSPACE_RGB = 'RGB'
 COLORSPACE_LAB = 'LAB'
+
+# upper bound of the D65-normalized XYZ values covered by the companding table, white is (1, 1, 1)
+XYZ_LUT_MAX = 1.01
+_COLOR_LUTS = {}
 tf.nn.softmax_cross_entropy_with_logits_v2
 
-def conv2d(inputs, filters, name, kernel_size=4, strides=2, bnorm=True, activation=None, seed=None):
+def conv2d(inputs, filters, name, kernel_size=4, strides=2, bnorm=True, activation=None, seed=None, training=True, fused=None, data_format='channels_last'):
     """
     Creates a conv2D block
+    training=False normalizes with the moving batch-norm statistics instead of the batch statistics
     """
     initializer=tf.variance_scaling_initializer(seed=seed)
     res = tf.layers.conv2d(
@@ -17,10 +22,12 @@ def conv2d(inputs, filters, name, kernel_size=4, strides=2, bnorm=True, activati
         kernel_size=kernel_size,
         strides=strides,
         padding="same",
+        data_format=data_format,
         kernel_initializer=initializer)
 
     if bnorm:
-        res = tf.layers.batch_normalization(inputs=res, name='bn_' + name, training=True)
+        axis = 1 if data_format == 'channels_first' else 3
+        res = tf.layers.batch_normalization(inputs=res, name='bn_' + name, axis=axis, training=training, fused=fused)
 
     # activation after batch-norm
     if activation is not None:
@@ -29,9 +36,10 @@ def conv2d(inputs, filters, name, kernel_size=4, strides=2, bnorm=True, activati
     return res
 
 
-def conv2d_transpose(inputs, filters, name, kernel_size=4, strides=2, bnorm=True, activation=None, seed=None):
+def conv2d_transpose(inputs, filters, name, kernel_size=4, strides=2, bnorm=True, activation=None, seed=None, training=True, fused=None, data_format='channels_last'):
     """
     Creates a conv2D-transpose block
+    training=False normalizes with the moving batch-norm statistics instead of the batch statistics
     """
     initializer=tf.variance_scaling_initializer(seed=seed)
     res = tf.layers.conv2d_transpose(
@@ -41,10 +49,12 @@ def conv2d_transpose(inputs, filters, name, kernel_size=4, strides=2, bnorm=True
         kernel_size=kernel_size,
         strides=strides,
         padding="same",
+        data_format=data_format,
         kernel_initializer=initializer)
 
     if bnorm:
-        res = tf.layers.batch_normalization(inputs=res, name='bn_' + name, training=True)
+        axis = 1 if data_format == 'channels_first' else 3
+        res = tf.layers.batch_normalization(inputs=res, name='bn_' + name, axis=axis, training=training, fused=fused)
 
     # activation after batch-norm
     if activation is not None:
@@ -53,12 +63,103 @@ def conv2d_transpose(inputs, filters, name, kernel_size=4, strides=2, bnorm=True
     return res
 
 
-def pixelwise_accuracy(img_real, img_fake, colorspace, thresh):
+def fold_batch_norm(weights, name, axis=3, epsilon=1e-3, fold=True):
+    """
+    Returns the kernel and bias of a conv block with its batch-norm folded in, using the moving statistics
+    with fold=False, the batch-norm is returned as a separate function applied after the bias
+    """
+    scope, layer = name.rsplit('/', 1)
+    kernel = weights[name + '/kernel']
+    bias = weights[name + '/bias']
+    bn = scope + '/bn_' + layer
+
+    if bn + '/gamma' in weights:
+        scale = weights[bn + '/gamma'] / np.sqrt(weights[bn + '/moving_variance'] + epsilon)
+        mean = weights[bn + '/moving_mean']
+        beta = weights[bn + '/beta']
+
+        if not fold:
+            def batch_norm(x):
+                return (x - mean.astype(np.float32)) * scale.astype(np.float32) + beta.astype(np.float32)
+
+            return kernel.astype(np.float32), bias.astype(np.float32), batch_norm
+
+        shape = [1, 1, 1, 1]
+        shape[axis] = -1
+        kernel = kernel * scale.reshape(shape)
+        bias = (bias - mean) * scale + beta
+
+    return kernel.astype(np.float32), bias.astype(np.float32), None
+
+
+def conv2d_frozen(inputs, weights, name, strides=2, activation=None, fold=True):
+    """
+    Creates an inference-only conv2D block from the given variable values
+    """
+    kernel, bias, bnorm = fold_batch_norm(weights, name, axis=3, fold=fold)
+    res = tf.nn.conv2d(inputs, kernel, strides=[1, strides, strides, 1], padding='SAME', name=name)
+    res = tf.nn.bias_add(res, bias)
+
+    if bnorm is not None:
+        res = bnorm(res)
+
+    if activation is not None:
+        res = activation(res)
+
+    return res
+
+
+def conv2d_transpose_frozen(inputs, weights, name, strides=2, activation=None, fold=True):
+    """
+    Creates an inference-only conv2D-transpose block from the given variable values
+    """
+    # transposed kernels are stored as [height, width, output channels, input channels]
+    kernel, bias, bnorm = fold_batch_norm(weights, name, axis=2, fold=fold)
+    shape = tf.shape(inputs)
+    output_shape = tf.stack([shape[0], shape[1] * strides, shape[2] * strides, kernel.shape[2]])
+    res = tf.nn.conv2d_transpose(inputs, kernel, output_shape, strides=[1, strides, strides, 1], padding='SAME', name=name)
+    res = tf.nn.bias_add(res, bias)
+
+    if bnorm is not None:
+        res = bnorm(res)
+
+    if activation is not None:
+        res = activation(res)
+
+    return res
+
+
+def average_towers(values):
+    """
+    Averages a scalar over data-parallel towers
+    """
+    if len(values) == 1:
+        return values[0]
+
+    return tf.add_n(values) / len(values)
+
+
+def average_gradients(tower_grads):
+    """
+    Averages the (gradient, variable) lists of data-parallel towers, variables are shared between towers
+    """
+    if len(tower_grads) == 1:
+        return tower_grads[0]
+
+    grads_and_vars = []
+    for tower_grad in zip(*tower_grads):
+        grads = [grad for grad, _ in tower_grad]
+        grads_and_vars.append((tf.add_n(grads) / len(grads), tower_grad[0][1]))
+
+    return grads_and_vars
+
+
+def pixelwise_accuracy(img_real, img_fake, colorspace, thresh, lut=False):
     """
     Measures the accuracy of the colorization process by comparing pixels
     """
-    img_real = postprocess(img_real, colorspace, COLORSPACE_LAB)
-    img_fake = postprocess(img_fake, colorspace, COLORSPACE_LAB)
+    img_real = postprocess(img_real, colorspace, COLORSPACE_LAB, lut=lut)
+    img_fake = postprocess(img_fake, colorspace, COLORSPACE_LAB, lut=lut)
 
     diffL = tf.abs(tf.round(img_real[..., 0]) - tf.round(img_fake[..., 0]))
     diffA = tf.abs(tf.round(img_real[..., 1]) - tf.round(img_fake[..., 1]))
@@ -75,17 +176,17 @@ def pixelwise_accuracy(img_real, img_fake, colorspace, thresh):
     return tf.reduce_mean(pred)
 
 
-def preprocess(img, colorspace_in, colorspace_out):
+def preprocess(img, colorspace_in, colorspace_out, lut=False):
     if colorspace_out.upper() == COLORSPACE_RGB:
         if colorspace_in == COLORSPACE_LAB:
-            img = lab_to_rgb(img)
+            img = lab_to_rgb(img, lut=lut)
 
         # [0, 1] => [-1, 1]
         img = (img / 255.0) * 2 - 1
 
     elif colorspace_out.upper() == COLORSPACE_LAB:
         if colorspace_in == COLORSPACE_RGB:
-            img = rgb_to_lab(img / 255.0)
+            img = rgb_to_lab(img / 255.0, lut=lut)
 
         L_chan, a_chan, b_chan = tf.unstack(img, axis=3)
 
@@ -96,13 +197,13 @@ def preprocess(img, colorspace_in, colorspace_out):
     return img
 
 
-def postprocess(img, colorspace_in, colorspace_out):
+def postprocess(img, colorspace_in, colorspace_out, lut=False):
     if colorspace_in.upper() == COLORSPACE_RGB:
         # [-1, 1] => [0, 1]
         img = (img + 1) / 2
 
         if colorspace_out == COLORSPACE_LAB:
-            img = rgb_to_lab(img)
+            img = rgb_to_lab(img, lut=lut)
 
     elif colorspace_in.upper() == COLORSPACE_LAB:
         L_chan, a_chan, b_chan = tf.unstack(img, axis=3)
@@ -112,20 +213,66 @@ def postprocess(img, colorspace_in, colorspace_out):
         img = tf.stack([(L_chan + 1) / 2 * 100, a_chan * 110, b_chan * 110], axis=3)
 
         if colorspace_out == COLORSPACE_RGB:
-            img = lab_to_rgb(img)
+            img = lab_to_rgb(img, lut=lut)
 
     return img
 
 
-def rgb_to_lab(srgb):
+def color_lut(name):
+    """
+    Returns a companding table sampled uniformly over its input range, see interpolate_lut
+    """
+    if name not in _COLOR_LUTS:
+        if name == 'srgb_to_linear':
+            # 8-bit sRGB values k / 255 are table entries, so quantized inputs are converted exactly
+            x = np.linspace(0.0, 1.0, 255 * 4 + 1)
+            table = np.where(x <= 0.04045, x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
+
+        elif name == 'xyz_to_f':
+            epsilon = 6 / 29
+            x = np.linspace(0.0, XYZ_LUT_MAX, 8192)
+            table = np.where(x <= epsilon**3, x / (3 * epsilon**2) + 4 / 29, np.cbrt(x))
+
+        elif name == 'linear_to_srgb':
+            x = np.linspace(0.0, 1.0, 8192)
+            table = np.where(x <= 0.0031308, x * 12.92, (x ** (1 / 2.4) * 1.055) - 0.055)
+
+        _COLOR_LUTS[name] = table.astype(np.float32)
+
+    return _COLOR_LUTS[name]
+
+
+def interpolate_lut(x, table, x_min, x_max):
+    """
+    Piecewise-linear lookup of x in a table sampled uniformly over [x_min, x_max], x is clipped to the range
+    """
+    size = len(table)
+    position = (tf.clip_by_value(x, x_min, x_max) - x_min) * ((size - 1) / (x_max - x_min))
+    index = tf.minimum(tf.cast(position, tf.int32), size - 2)
+    fraction = position - tf.cast(index, tf.float32)
+
+    table = tf.constant(table)
+    lower = tf.gather(table, index)
+    upper = tf.gather(table, index + 1)
+
+    return lower + (upper - lower) * fraction
+
+
+def rgb_to_lab(srgb, lut=False):
     # based on https://github.com/torch/image/blob/9f65c30167b2048ecbe8b7befdc6b2d6d12baee9/generic/image.c
+    # lut=True interpolates precomputed companding tables, within 1e-3 of the formula in LAB units
     with tf.name_scope("rgb_to_lab"):
         srgb_pixels = tf.reshape(srgb, [-1, 3])
 
         with tf.name_scope("srgb_to_xyz"):
-            linear_mask = tf.cast(srgb_pixels <= 0.04045, dtype=tf.float32)
-            exponential_mask = tf.cast(srgb_pixels > 0.04045, dtype=tf.float32)
-            rgb_pixels = (srgb_pixels / 12.92 * linear_mask) + (((srgb_pixels + 0.055) / 1.055) ** 2.4) * exponential_mask
+            if lut:
+                rgb_pixels = interpolate_lut(srgb_pixels, color_lut('srgb_to_linear'), 0.0, 1.0)
+
+            else:
+                linear_mask = tf.cast(srgb_pixels <= 0.04045, dtype=tf.float32)
+                exponential_mask = tf.cast(srgb_pixels > 0.04045, dtype=tf.float32)
+                rgb_pixels = (srgb_pixels / 12.92 * linear_mask) + (((srgb_pixels + 0.055) / 1.055) ** 2.4) * exponential_mask
+
             rgb_to_xyz = tf.constant([
                 #    X        Y          Z
                 [0.412453, 0.212671, 0.019334],  # R
@@ -141,9 +288,13 @@ def rgb_to_lab(srgb):
             xyz_normalized_pixels = tf.multiply(xyz_pixels, [1 / 0.950456, 1.0, 1 / 1.088754])
 
             epsilon = 6 / 29
-            linear_mask = tf.cast(xyz_normalized_pixels <= (epsilon**3), dtype=tf.float32)
-            exponential_mask = tf.cast(xyz_normalized_pixels > (epsilon**3), dtype=tf.float32)
-            fxfyfz_pixels = (xyz_normalized_pixels / (3 * epsilon**2) + 4 / 29) * linear_mask + (xyz_normalized_pixels ** (1 / 3)) * exponential_mask
+            if lut:
+                fxfyfz_pixels = interpolate_lut(xyz_normalized_pixels, color_lut('xyz_to_f'), 0.0, XYZ_LUT_MAX)
+
+            else:
+                linear_mask = tf.cast(xyz_normalized_pixels <= (epsilon**3), dtype=tf.float32)
+                exponential_mask = tf.cast(xyz_normalized_pixels > (epsilon**3), dtype=tf.float32)
+                fxfyfz_pixels = (xyz_normalized_pixels / (3 * epsilon**2) + 4 / 29) * linear_mask + (xyz_normalized_pixels ** (1 / 3)) * exponential_mask
 
             # convert to lab
             fxfyfz_to_lab = tf.constant([
@@ -157,7 +308,8 @@ def rgb_to_lab(srgb):
         return tf.reshape(lab_pixels, tf.shape(srgb))
 
 
-def lab_to_rgb(lab):
+def lab_to_rgb(lab, lut=False):
+    # lut=True interpolates a precomputed companding table, within 1e-4 of the formula in RGB [0, 1] units
     with tf.name_scope("lab_to_rgb"):
         lab_pixels = tf.reshape(lab, [-1, 3])
 
@@ -191,8 +343,13 @@ def lab_to_rgb(lab):
             rgb_pixels = tf.matmul(xyz_pixels, xyz_to_rgb)
             # avoid a slightly negative number messing up the conversion
             rgb_pixels = tf.clip_by_value(rgb_pixels, 0.0, 1.0)
-            linear_mask = tf.cast(rgb_pixels <= 0.0031308, dtype=tf.float32)
-            exponential_mask = tf.cast(rgb_pixels > 0.0031308, dtype=tf.float32)
-            srgb_pixels = (rgb_pixels * 12.92 * linear_mask) + ((rgb_pixels ** (1 / 2.4) * 1.055) - 0.055) * exponential_mask
+
+            if lut:
+                srgb_pixels = interpolate_lut(rgb_pixels, color_lut('linear_to_srgb'), 0.0, 1.0)
+
+            else:
+                linear_mask = tf.cast(rgb_pixels <= 0.0031308, dtype=tf.float32)
+                exponential_mask = tf.cast(rgb_pixels > 0.0031308, dtype=tf.float32)
+                srgb_pixels = (rgb_pixels * 12.92 * linear_mask) + ((rgb_pixels ** (1 / 2.4) * 1.055) - 0.055) * exponential_mask
 
         return tf.reshape(srgb_pixels, tf.shape(lab))
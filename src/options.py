@@ -18,9 +18,12 @@ class ModelOptions:
         parser = argparse.ArgumentParser(description='Colorization with GANs')
         parser.add_argument('--seed', type=int, default=0, metavar='S', help='random seed (default: 0)')
         parser.add_argument('--name', type=str, default='CGAN', help='arbitrary model name (default: CGAN)')
-        parser.add_argument('--mode', default=0, help='run mode [0: train, 1: test, 2: turing-test] (default: 0)')
+        parser.add_argument('--mode', type=int, default=0, help='run mode [0: train, 1: test, 2: turing-test, 3: export, 4: quantize, 5: serve] (default: 0)')
         parser.add_argument('--dataset', type=str, default='places365', help='the name of dataset [places365, cifar10] (default: places365)')
         parser.add_argument('--dataset-path', type=str, default='./dataset', help='dataset path (default: ./dataset)')
+        parser.add_argument('--packed-path', type=str, default='', help='path to the packed dataset shards, empty for reading the original images (default: \'\')')
+        parser.add_argument('--shard-size', type=int, default=4096, metavar='N', help='number of images per packed dataset shard (default: 4096)')
+        parser.add_argument('--skip-near-grayscale', type=str2bool, default=False, help='True for dropping nearly grayscale images as well as grayscale ones (default: False)')
         parser.add_argument('--checkpoints-path', type=str, default='./checkpoints', help='models are saved here (default: ./checkpoints)')
         parser.add_argument('--batch-size', type=int, default=16, metavar='N', help='input batch size for training (default: 16)')
         parser.add_argument('--color-space', type=str, default='lab', help='model color space [lab, rgb] (default: lab)')
@@ -34,24 +37,69 @@ class ModelOptions:
         parser.add_argument('--augment', type=str2bool, default=True, help='True for augmentation (default: True)')
         parser.add_argument('--label-smoothing', type=str2bool, default=False, help='True for one-sided label smoothing (default: False)')
         parser.add_argument('--acc-thresh', type=float, default=2.0, help="accuracy threshold (default: 2.0)")
-        parser.add_argument('--gpu-ids', type=str, default='0', help='gpu ids: e.g. 0  0,1,2, 0,2. use -1 for CPU')
+        parser.add_argument('--workers', type=int, default=0, metavar='N', help='number of data loading threads, 0 for loading on the training thread (default: 0)')
+        parser.add_argument('--prefetch', type=int, default=2, metavar='N', help='number of batches to load ahead when using data loading threads (default: 2)')
+        parser.add_argument('--color-lut', type=str2bool, default=False, help='True for color space conversion with interpolated lookup tables instead of the exact formulas (default: False)')
+        parser.add_argument('--inference-bn', type=str2bool, default=False, help='True for sampling with the moving batch-norm statistics instead of the batch statistics (default: False)')
+        parser.add_argument('--fused-bn', type=str2bool, default=True, help='True for using the fused batch-norm kernels (default: True)')
+        parser.add_argument('--data-format', type=str, default='channels_last', help='convolution data layout [channels_last, channels_first], channels_first requires a GPU (default: channels_last)')
+        parser.add_argument('--host-preprocess', type=str2bool, default=False, help='True for converting the training images to the model inputs on the data loading workers (default: False)')
+        parser.add_argument('--fused-step', type=str2bool, default=True, help='True for fetching losses and accuracy with the last update op of each training step (default: True)')
+        parser.add_argument('--dis-steps', type=int, default=1, metavar='N', help='number of discriminator updates per training step (default: 1)')
+        parser.add_argument('--gen-steps', type=int, default=2, metavar='N', help='number of generator updates per training step (default: 2)')
+        parser.add_argument('--distributed-workers', type=int, default=0, metavar='N', help='number of local worker processes to launch for distributed training, 0 for a single process (default: 0)')
+        parser.add_argument('--port', type=int, default=2222, help='first port of the local distributed training processes (default: 2222)')
+        parser.add_argument('--ps-hosts', type=str, default='', help='comma-separated parameter server host:port pairs for distributed training')
+        parser.add_argument('--worker-hosts', type=str, default='', help='comma-separated worker host:port pairs for distributed training')
+        parser.add_argument('--job-name', type=str, default='', help='distributed training job of this process [ps, worker]')
+        parser.add_argument('--task-index', type=int, default=0, help='index of this process within its distributed training job (default: 0)')
+        parser.add_argument('--cpu-towers', type=int, default=0, metavar='N', help='number of logical CPU devices to split each batch across, overrides --gpu-ids when > 1 (default: 0)')
+        parser.add_argument('--finalize-graph', type=str2bool, default=False, help='True for finalizing the graph after the model is built (default: False)')
+        parser.add_argument('--gpu-ids', type=str, default='0', help='gpu ids: e.g. 0  0,1,2, 0,2. use -1 for CPU, each batch is split across multiple gpus')
         
         parser.add_argument('--save', type=str2bool, default=True, help='True for saving (default: True)')
+        parser.add_argument('--async-save', type=str2bool, default=True, help='True for writing checkpoints on a background thread (default: True)')
+        parser.add_argument('--keep-checkpoints', type=int, default=5, metavar='N', help='number of recent checkpoints to keep (default: 5)')
+        parser.add_argument('--keep-checkpoint-hours', type=float, default=0, help='also keep one checkpoint every this many hours, 0 for none (default: 0)')
         parser.add_argument('--save-interval', type=int, default=1000, help='how many batches to wait before saving model (default: 1000)')
         parser.add_argument('--sample', type=str2bool, default=True, help='True for sampling (default: True)')
         parser.add_argument('--sample-size', type=int, default=8, help='number of images to sample (default: 8)')
         parser.add_argument('--sample-interval', type=int, default=1000, help='how many batches to wait before sampling (default: 1000)')
         parser.add_argument('--validate', type=str2bool, default=True, help='True for validation (default: True)')
+        parser.add_argument('--validate-size', type=int, default=0, metavar='N', help='number of validation images to validate on, 0 for the whole validation set (default: 0)')
+        parser.add_argument('--validate-cache-mb', type=int, default=2048, metavar='N', help='max MB of decoded validation images to cache, 0 for none (default: 2048)')
         parser.add_argument('--validate-interval', type=int, default=0, help='how many batches to wait before validating (default: 0)')
         parser.add_argument('--log', type=str2bool, default=False, help='True for logging (default: True)')
         parser.add_argument('--log-interval', type=int, default=10, help='how many iterations to wait before logging training status (default: 10)')
         parser.add_argument('--visualize', type=str2bool, default=False, help='True for accuracy visualization (default: False)')
+        parser.add_argument('--profile-interval', type=int, default=0, metavar='N', help='how many iterations to wait between full session traces, 0 for no profiling (default: 0)')
+        parser.add_argument('--tensorboard', type=str2bool, default=False, help='True for also writing the logged metrics as TensorBoard events (default: False)')
         parser.add_argument('--visualize-window', type=int, default=100, help='the exponentially moving average window width (default: 100)')
         
         parser.add_argument('--test-input', type=str, default='', help='path to the grayscale images directory or a grayscale file')
         parser.add_argument('--test-output', type=str, default='', help='model test output directory')
+        parser.add_argument('--frozen-model', type=str, default='', help='path to the exported frozen generator, written in export mode and used for testing if set (default: \'\')')
+        parser.add_argument('--quantized-model', type=str, default='', help='path to the int8 TensorFlow Lite generator, written in quantize mode and used for testing if set (default: \'\')')
+        parser.add_argument('--quantize-samples', type=int, default=100, metavar='N', help='number of validation images to calibrate on, as many are held out (default: 100)')
+        parser.add_argument('--test-batch-size', type=int, default=8, metavar='N', help='number of test images to colorize at once, 1 without --inference-bn or an exported model (default: 8)')
+        parser.add_argument('--tile-size', type=int, default=0, metavar='N', help='size of the overlapping tiles to colorize test images in, 0 for whole images (default: 0)')
+        parser.add_argument('--tile-overlap', type=int, default=32, metavar='N', help='number of pixels adjacent tiles overlap (default: 32)')
         parser.add_argument('--turing-test-size', type=int, default=100, metavar='N', help='number of Turing tests (default: 100)')
         parser.add_argument('--turing-test-delay', type=int, default=0, metavar='N', help='number of seconds to wait when doing Turing test, 0 for unlimited (default: 0)')
+        parser.add_argument('--turing-test-pairs', type=str, default='', help='file to save the generated Turing test pairs to, or to replay them from if it exists (default: \'\')')
+        parser.add_argument('--server-host', type=str, default='127.0.0.1', help='address the colorization server listens on (default: 127.0.0.1)')
+        parser.add_argument('--server-port', type=int, default=8080, help='port the colorization server listens on (default: 8080)')
+        parser.add_argument('--server-batch-size', type=int, default=8, metavar='N', help='max number of requests the server colorizes at once (default: 8)')
+        parser.add_argument('--server-max-delay', type=float, default=10, help='max ms a request waits for its batch to fill (default: 10)')
+        parser.add_argument('--server-bucket-size', type=int, default=0, metavar='N', help='server images are padded to a multiple of this size to be batched (default: 0)')
+        parser.add_argument('--load-concurrency', type=int, default=8, metavar='N', help='number of concurrent clients of the load generator (default: 8)')
+        parser.add_argument('--load-requests', type=int, default=200, metavar='N', help='number of requests sent by the load generator (default: 200)')
+        parser.add_argument('--benchmark-sizes', type=str, default='', help='comma-separated generator input sizes to benchmark, empty for half and full dataset size (default: \'\')')
+        parser.add_argument('--benchmark-batch-sizes', type=str, default='1,8,32', help='comma-separated generator batch sizes to benchmark (default: 1,8,32)')
+        parser.add_argument('--benchmark-runs', type=int, default=10, metavar='N', help='number of timed runs per benchmark (default: 10)')
+        parser.add_argument('--benchmark-output', type=str, default='', help='file to save the benchmark results to as JSON (default: \'\')')
+        parser.add_argument('--benchmark-baseline', type=str, default='', help='benchmark results JSON to compare to, regressions raise an error (default: \'\')')
+        parser.add_argument('--benchmark-tolerance', type=float, default=0.2, help='relative slowdown against the baseline counted as a regression (default: 0.2)')
 
         self._parser = parser
 
@@ -60,7 +108,7 @@ class ModelOptions:
         os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu_ids
 
         opt.color_space = opt.color_space.upper()
-        opt.training = opt.mode == 1
+        opt.training = opt.mode in (1, 5)
 
         if opt.seed == 0:
             opt.seed = random.randint(0, 2**31 - 1)
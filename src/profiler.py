@@ -0,0 +1,109 @@
+from __future__ import print_function
+
+import os
+import time
+import collections
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+PROFILE_PHASES = ['data', 'feed', 'run', 'log', 'sample', 'validate', 'save']
+PROFILE_LOG_COLUMNS = ['epoch', 'step'] + PROFILE_PHASES
+
+
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, time.time() - self.start)
+
+
+class _NullPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class StepProfiler:
+    '''
+    Times the host-side phases of the training steps and captures a full session trace every
+    trace_interval steps, saved as a Chrome trace (chrome://tracing). A disabled profiler
+    does nothing, its phases are shared no-op context managers.
+    '''
+    def __init__(self, trace_dir, trace_interval=0):
+        self.trace_dir = trace_dir
+        self.trace_interval = trace_interval
+        self.enabled = trace_interval > 0
+        self._step = collections.OrderedDict((phase, 0.0) for phase in PROFILE_PHASES)
+        self._last = []
+        self._totals = collections.OrderedDict((phase, 0.0) for phase in PROFILE_PHASES)
+        self._count = 0
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else _NULL_PHASE
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self._step[name] += seconds
+
+    def end_step(self):
+        if not self.enabled:
+            return
+
+        self._last = [(phase + ' ms', seconds * 1e3) for phase, seconds in self._step.items()]
+
+        for phase, seconds in self._step.items():
+            self._totals[phase] += seconds
+            self._step[phase] = 0.0
+
+        self._count += 1
+
+    def values(self):
+        '''
+        returns the phase durations of the last completed step, in ms, as progress bar values
+        '''
+        return self._last
+
+    def averages(self):
+        '''
+        returns the mean seconds per step of each phase since the previous call
+        '''
+        averages = [seconds / max(1, self._count) for seconds in self._totals.values()]
+
+        for phase in self._totals:
+            self._totals[phase] = 0.0
+
+        self._count = 0
+        return averages
+
+    def run_metadata(self, iteration):
+        '''
+        returns a RunMetadata to trace the session runs of this iteration into, or None
+        '''
+        if not self.enabled or iteration % self.trace_interval != 0:
+            return None
+
+        return tf.RunMetadata()
+
+    def save_trace(self, run_metadata, step):
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+
+        path = os.path.join(self.trace_dir, 'timeline_%d.json' % step)
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True)
+
+        with open(path, 'w') as f:
+            f.write(trace)
+
+        return path
@@ -0,0 +1,323 @@
+from __future__ import print_function
+
+import io
+import json
+import time
+import threading
+import collections
+import urllib.request
+import numpy as np
+from PIL import Image
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .dataset import TestDataset
+
+
+def percentiles(seconds):
+    '''
+    returns the median and 99th percentile of a list of durations, in ms
+    '''
+    if len(seconds) == 0:
+        return {}
+
+    p50, p99 = np.percentile(np.array(seconds) * 1e3, [50, 99])
+    return {'p50': p50, 'p99': p99}
+
+
+class _Request:
+    def __init__(self, img_gray):
+        self.img_gray = img_gray
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+class MicroBatcher:
+    '''
+    Groups concurrent colorization requests into batches run by a single thread. The requests are queued
+    by resolution bucket, their grayscale images are padded to the bucket size so that a bucket is colorized
+    in one session run. A bucket is run once it holds max_batch_size images or its oldest request has
+    waited max_delay seconds, the bucket with the oldest request first.
+    With the batch statistics, the outputs depend on the batch and the padding, so requests are run one at
+    a time, padded only to the generator stride.
+    '''
+    def __init__(self, model, max_batch_size=8, max_delay=0.01, bucket_size=0, history=10000):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_delay = max_delay
+
+        if not model.batch_independent():
+            self.max_batch_size = 1
+            bucket_size = 0
+
+        stride = model.generator_stride()
+        self.bucket_size = int(np.ceil(float(max(bucket_size, 1)) / stride) * stride)
+
+        self.requests = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen=history)
+        self.run_times = collections.deque(maxlen=history)
+
+        self._buckets = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        self._thread.join()
+
+    def colorize(self, img_gray):
+        '''
+        queues a grayscale image and waits for its batch to be run
+        returns the RGB uint8 image
+        '''
+        height, width = img_gray.shape[:2]
+        bucket = (
+            int(np.ceil(float(height) / self.bucket_size)) * self.bucket_size,
+            int(np.ceil(float(width) / self.bucket_size)) * self.bucket_size
+        )
+
+        request = _Request(img_gray)
+
+        with self._condition:
+            self._buckets.setdefault(bucket, []).append(request)
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+            self._condition.notify()
+
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.output
+
+    def queue_depth(self):
+        return sum(len(requests) for requests in self._buckets.values())
+
+    def metrics(self):
+        with self._condition:
+            return {
+                'queue_depth': self.queue_depth(),
+                'max_queue_depth': self.max_queue_depth,
+                'requests': self.requests,
+                'errors': self.errors,
+                'batches': sum(self.batch_sizes.values()),
+                'batch_sizes': dict((str(size), count) for size, count in sorted(self.batch_sizes.items())),
+                'latency_ms': percentiles(self.latencies),
+                'run_ms': percentiles(self.run_times),
+            }
+
+    def _next_batch(self):
+        '''
+        waits, holding the lock, for a bucket to be full or for its oldest request to expire
+        returns (bucket, requests), or (None, None) once stopped
+        '''
+        while self._running:
+            now = time.time()
+            ready = [
+                bucket for bucket, requests in self._buckets.items()
+                if len(requests) >= self.max_batch_size or now - requests[0].arrival >= self.max_delay
+            ]
+
+            if ready:
+                bucket = min(ready, key=lambda bucket: self._buckets[bucket][0].arrival)
+                requests = self._buckets[bucket]
+                batch = requests[:self.max_batch_size]
+                del requests[:self.max_batch_size]
+
+                if not requests:
+                    del self._buckets[bucket]
+
+                return bucket, batch
+
+            deadlines = [requests[0].arrival + self.max_delay for requests in self._buckets.values()]
+            self._condition.wait(min(deadlines) - now if deadlines else None)
+
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                bucket, batch = self._next_batch()
+
+            if batch is None:
+                return
+
+            start = time.time()
+            height, width = bucket
+
+            try:
+                inputs = [
+                    np.pad(request.img_gray, ((0, height - request.img_gray.shape[0]), (0, width - request.img_gray.shape[1])), mode='symmetric')
+                    for request in batch
+                ]
+
+                outputs = self.model.colorize_images(inputs)
+                for request, output in zip(batch, outputs):
+                    request.output = output[:request.img_gray.shape[0], :request.img_gray.shape[1]]
+
+            except Exception as error:
+                for request in batch:
+                    request.error = error
+
+            end = time.time()
+
+            with self._condition:
+                self.batch_sizes[len(batch)] += 1
+                self.run_times.append(end - start)
+
+                for request in batch:
+                    self.latencies.append(end - request.arrival)
+                    self.errors += request.error is not None
+
+            for request in batch:
+                request.done.set()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/colorize':
+            self.send_error(404)
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        try:
+            img_gray = np.array(Image.open(io.BytesIO(body)).convert('L'))
+        except Exception:
+            self.send_error(400, 'the request body is not an image')
+            return
+
+        try:
+            output = self.server.batcher.colorize(img_gray)
+        except Exception as error:
+            self.send_error(500, str(error))
+            return
+
+        buffer = io.BytesIO()
+        Image.fromarray(output).save(buffer, format='PNG')
+        self._send('image/png', buffer.getvalue())
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        self._send('application/json', json.dumps(self.server.batcher.metrics()).encode('utf-8'))
+
+    def _send(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # requests are not logged, see the metrics instead
+        pass
+
+
+def serve(model, options):
+    '''
+    serves the model over HTTP until interrupted:
+    POST /colorize with an image body returns the colorized PNG image
+    GET /metrics returns the queue depth, batch-size histogram and latency percentiles as JSON
+    '''
+    batcher = MicroBatcher(model, options.server_batch_size, options.server_max_delay / 1e3, options.server_bucket_size)
+    server = ThreadingHTTPServer((options.server_host, options.server_port), _Handler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    batcher.start()
+
+    if not model.batch_independent():
+        print('the batch statistics are used, requests are colorized one at a time (see --inference-bn)')
+
+    print('serving on http://%s:%d - max batch size: %d - max delay: %.1fms - bucket size: %d' % (
+        options.server_host, server.server_address[1], batcher.max_batch_size, batcher.max_delay * 1e3, batcher.bucket_size))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+        batcher.stop()
+
+
+def load_test(options):
+    '''
+    sends options.load_requests colorization requests of the test images to a running server,
+    from options.load_concurrency threads
+    returns the client latencies and the server metrics
+    '''
+    url = 'http://%s:%d' % (options.server_host, options.server_port)
+    dataset = TestDataset(options.test_input or (options.checkpoints_path + '/test'))
+    bodies = []
+    for path in dataset.data:
+        with open(path, 'rb') as f:
+            bodies.append(f.read())
+
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    next_index = [0]
+
+    def client():
+        while True:
+            with lock:
+                index = next_index[0]
+                next_index[0] += 1
+
+            if index >= options.load_requests:
+                return
+
+            start = time.time()
+
+            try:
+                request = urllib.request.Request(url + '/colorize', data=bodies[index % len(bodies)], headers={'Content-Type': 'application/octet-stream'})
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+
+            except Exception:
+                with lock:
+                    errors[0] += 1
+
+            with lock:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    clients = [threading.Thread(target=client) for _ in range(max(1, options.load_concurrency))]
+    for thread in clients:
+        thread.start()
+
+    for thread in clients:
+        thread.join()
+
+    elapsed = time.time() - start
+
+    with urllib.request.urlopen(url + '/metrics') as response:
+        metrics = json.loads(response.read().decode('utf-8'))
+
+    latency = percentiles(latencies)
+    print('requests: %d - errors: %d - concurrency: %d - %.2f requests/sec' % (
+        len(latencies), errors[0], options.load_concurrency, len(latencies) / max(elapsed, 1e-6)))
+    print('client latency: p50: %.1fms - p99: %.1fms' % (latency.get('p50', 0), latency.get('p99', 0)))
+    print('server: batches: %d - batch sizes: %s - max queue depth: %d - latency p50: %.1fms - p99: %.1fms' % (
+        metrics['batches'], metrics['batch_sizes'], metrics['max_queue_depth'], metrics['latency_ms'].get('p50', 0), metrics['latency_ms'].get('p99', 0)))
+
+    return {'latency_ms': latency, 'errors': errors[0], 'server': metrics}
@@ -5,7 +5,6 @@ import random
 import pickle
 import numpy as np
 from PIL import Image
-import matplotlib.pyplot as plt
 
 
 def stitch_images(grayscale, original, pred):
@@ -23,7 +22,7 @@ def stitch_images(grayscale, original, pred):
         yoffset = int(ix / img_per_row) * height
         im1 = Image.fromarray(grayscale[ix])
         im2 = Image.fromarray(original[ix])
-        im3 = Image.fromarray((pred[ix] * 255).astype(np.uint8))
+        im3 = Image.fromarray(pred[ix])
         img.paste(im1, (xoffset, yoffset))
         img.paste(im2, (xoffset + width, yoffset))
         img.paste(im3, (xoffset + width + width, yoffset))
@@ -51,6 +50,9 @@ def moving_average(data, window_width):
 
 
 def imshow(img, title=''):
+    # pyplot is imported on first use, it is slow to import and not needed to train or test
+    import matplotlib.pyplot as plt
+
     fig = plt.gcf()
     fig.canvas.set_window_title(title)
     plt.axis('off')
@@ -64,8 +66,10 @@ def imsave(img, path):
 
 
 def turing_test(real_img, fake_img, delay=0):
+    import matplotlib.pyplot as plt
+
     height, width, _ = real_img.shape
-    imgs = np.array([real_img, (fake_img * 255).astype(np.uint8)])
+    imgs = np.array([real_img, fake_img])
     real_index = np.random.binomial(1, 0.5)
     fake_index = (real_index + 1) % 2
 
@@ -97,15 +101,38 @@ def turing_test(real_img, fake_img, delay=0):
     return img.success
 
 
-def visualize(train_log_file, test_log_file, window_width, title=''):
-    train_data = np.loadtxt(train_log_file)
-    test_data = np.loadtxt(test_log_file)
+def run_turing_test(pairs, delay=0):
+    count = 0
+    score = 0
+
+    for real_img, fake_img in pairs:
+        res = turing_test(real_img, fake_img, delay)
+        count += 1
+        score += res
+        print('success: %d - fail: %d - rate: %f' % (score, count - score, (count - score) / count))
+
+    return score, count
+
+
+def save_turing_pairs(path, real_imgs, fake_imgs):
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, real=np.array(real_imgs, dtype=np.uint8), fake=np.array(fake_imgs, dtype=np.uint8))
+
+
+def load_turing_pairs(path):
+    pairs = np.load(path)
+    return list(zip(pairs['real'], pairs['fake']))
+
+
+def visualize(train_log, test_log, title=''):
+    # the logs keep the recent rows and moving averages in memory, see metrics.MetricsLogger
+    train_acc = train_log.values('acc', average=True)
+    test_acc = test_log.values('acc')
 
-    if len(train_data.shape) < 2:
+    if len(train_acc) < 2:
         return
 
-    if len(train_data) < window_width:
-        window_width = len(train_data) - 1
+    import matplotlib.pyplot as plt
 
     fig = plt.gcf()
     fig.canvas.set_window_title(title)
@@ -113,14 +140,13 @@ def visualize(train_log_file, test_log_file, window_width, title=''):
     plt.ion()
     plt.subplot('121')
     plt.cla()
-    if len(train_data) > 1:
-        plt.plot(moving_average(train_data[:, 8], window_width))
+    plt.plot(train_acc)
     plt.title('train')
 
     plt.subplot('122')
     plt.cla()
-    if len(test_data) > 1:
-        plt.plot(test_data[:, 8])
+    if len(test_acc) > 1:
+        plt.plot(test_acc)
     plt.title('test')
 
     plt.show()